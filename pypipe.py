@@ -17,21 +17,32 @@ See the License for the specific language governing permissions and
 limitations under the License.
 """
 import argparse
-import ast
-import atexit
-import importlib.util
-import re
-import shutil
-import signal
-import subprocess
+import marshal
 import sys
-from os import chmod, environ
+from os import chmod, environ, getpid, makedirs, remove, replace, scandir, stat, utime
+from os.path import expanduser, join
+from types import CodeType, ModuleType
 
 __version__ = "0.4.1"
 
 
 INDENT = " " * 4
 
+CACHE_SIZE = 16 * 1024 * 1024
+NEGATIVE_IMPORTS_FILE = "negative_imports.bin"
+NEGATIVE_IMPORTS_SIZE = 1000
+PAGER_BUFFER_SIZE = 1024 * 1024
+
+# Variables defined by the generated code. They are never probed as modules.
+LOCAL_NAMES = {
+    "i", "line", "l", "rec", "r", "dic", "d", "header", "text", "path", "file",
+    "counter", "c", "reader", "writer", "pattern", "viewer", "view",
+    "I", "S", "B", "L", "D", "SET", "_p", "_w", "_print", "_write",
+}
+
+# Results of find_spec, memoized for the lifetime of the interpreter.
+_found_modules = {}
+
 FIELD_TYPE_TMPL = {
     "i": r"int({})",
     "f": r"float({})",
@@ -40,11 +51,11 @@ FIELD_TYPE_TMPL = {
 }
 
 TEMPLATE_LINE = r"""
-{imp}
+{imp}{io}
 
 {pre}
 
-for i, line in enumerate(sys.stdin, 1):
+for i, line in enumerate({source}, 1):
     line = line.rstrip("\r\n")
     l = line  # ABBREV
 {loop_head}
@@ -55,12 +66,12 @@ for i, line in enumerate(sys.stdin, 1):
 """
 
 TEMPLATE_REC = r"""
-{imp}
+{imp}{io}
 
 {prepre}
 {pre}
 
-for i, line in enumerate(sys.stdin, 1):
+for i, line in enumerate({source}, 1):
     line = line.rstrip("\r\n")
     {parse_line}
     r = rec  # ABBREV
@@ -71,9 +82,7 @@ for i, line in enumerate(sys.stdin, 1):
 {post}
 """
 
-TEMPLATE_CSV = r"""
-{imp}
-
+TEMPLATE_CSV_PRELUDE = r"""
 def _write(*args, writer=None):
     if len(args) == 1 and isinstance(args[0], (list, tuple)):
         writer.writerow(args[0])
@@ -84,11 +93,88 @@ def _write(*args, writer=None):
 reader = csv.reader(sys.stdin, {reader_opts})
 writer = csv.writer(sys.stdout, {writer_opts})
 _w = writer.writerow   # ABBREV
+""".strip("\n")
+
+CSV_FAST_PRELUDE = r"""
+class _CsvLines:
+    # Parses a record by csv.reader. The rest of a quoted field spanning
+    # lines is read from the same stream.
+
+    def __init__(self, stream, **opts):
+        self.stream = stream
+        self.line = None
+        self.reader = csv.reader(self, **opts)
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if self.line is None:
+            return next(self.stream)
+        line, self.line = self.line, None
+        return line
+
+    def __call__(self, line):
+        self.line = line
+        return next(self.reader)
+
+
+def _csv_line(line):
+    # Most of the lines with quotes are whole records; they are parsed
+    # without leaving C. The csv.reader resets its state on each record.
+    _csv_pending.append(line)
+    try:
+        return next(_csv_reader)
+    except IndexError:
+        return _csv_lines(line)
+
+
+def _csv_records(stream):
+    # Lines without quotes are split. Blank lines (and all lines shorter
+    # than 3 characters) are left to csv.reader, which returns [] for them.
+    for line in stream:
+        if '"' in line or len(line) < 3:
+            yield _csv_line(line)
+        else:
+            yield line.rstrip('\r\n').split({delimiter})
+
+
+_PLAIN_TYPES = {{str, int, float, bool}}
+
+def _write(*args, writer=None):
+    row = args[0] if len(args) == 1 and isinstance(args[0], (list, tuple)) else args
+    try:
+        line = {output_delimiter}.join(row)
+    except TypeError:
+        # csv.writer formats None as '' and float subclasses by repr().
+        if not all(type(v) in _PLAIN_TYPES for v in row):
+            writer.writerow(row)
+            return
+        line = {output_delimiter}.join(map(str, row))
+    # Fields that csv.writer would quote, and the empty rows.
+    if not line or '"' in line or '\n' in line or '\r' in line or line.count({output_delimiter}) != len(row) - 1:
+        writer.writerow(row)
+        return
+    sys.stdout.write(line + '\r\n')
+
+
+_csv_pending = []
+_csv_reader = csv.reader(iter(_csv_pending.pop, None), {reader_opts})
+_csv_lines = _CsvLines(sys.stdin, {reader_opts})
+reader = _csv_records(sys.stdin)
+writer = csv.writer(sys.stdout, {writer_opts})
+_w = writer.writerow   # ABBREV
+""".strip("\n")
+
+TEMPLATE_CSV = r"""
+{imp}{io}
+
+{prelude}
 {prepre}
 {pre}
 
-for i, rec in enumerate(reader, 1):
-    r = rec  # ABBREV
+for i, {loop}:
+{parse_line}    r = rec  # ABBREV
 {loop_head}
 {loop_filter}
 {main}
@@ -97,7 +183,7 @@ for i, rec in enumerate(reader, 1):
 """
 
 TEMPLATE_TEXT = r"""
-{imp}
+{imp}{io}
 
 {pre}
 
@@ -108,21 +194,166 @@ text = sys.stdin.read()
 {post}
 """
 
-TEMPLATE_FILE = r"""
-{imp}
+TEMPLATE_TEXT_STREAM = r"""
+{imp}{io}
+
+{pre}
+
+for i, (key, dic) in enumerate(_JsonStream(sys.stdin).items({path!r}), 1):
+    d = dic  #ABBREV
+{loop_head}
+{loop_filter}
+{main}
+
+{post}
+"""
+
+JSON_STREAM_FUNC = r"""
+class _JsonStream:
+    # Reads the elements of a JSON array (or the members of an object) one
+    # by one with raw_decode, keeping only the unread part in the buffer.
+
+    WHITESPACE = re.compile(r'[ \t\n\r]*')
+
+    def __init__(self, stream, size=1 << 20):
+        self.stream = stream
+        self.size = size
+        self.buf = ""
+        self.pos = 0
+        self.scan = json.JSONDecoder().scan_once
+
+    def _fill(self):
+        # Read at least as much as is buffered so that retrying a large
+        # value stays linear.
+        chunk = self.stream.read(max(self.size, len(self.buf) - self.pos))
+        if not chunk:
+            return False
+        self.buf = self.buf[self.pos:] + chunk
+        self.pos = 0
+        return True
+
+    def _peek(self):
+        while True:
+            self.pos = self.WHITESPACE.match(self.buf, self.pos).end()
+            if self.pos < len(self.buf):
+                return self.buf[self.pos]
+            if not self._fill():
+                return ""
+
+    def _expect(self, chars):
+        c = self.buf[self.pos:self.pos + 1]
+        if not c or c not in chars:
+            c = self._peek()
+            if not c or c not in chars:
+                raise ValueError(f"expected one of {chars!r} but got {c!r} in the JSON stream")
+        self.pos += 1
+        return c
+
+    def _value(self):
+        while True:
+            self.pos = self.WHITESPACE.match(self.buf, self.pos).end()
+            try:
+                value, end = self.scan(self.buf, self.pos)
+            except StopIteration:
+                if not self._fill():
+                    raise ValueError(f"invalid JSON value at {self.buf[self.pos:self.pos + 20]!r}")
+                continue
+            except json.JSONDecodeError:
+                if not self._fill():
+                    raise
+                continue
+            # A number at the end of the buffer may continue in the next chunk.
+            if end == len(self.buf) and self._fill():
+                continue
+            self.pos = end
+            return value
+
+    def items(self, path):
+        for name in path[:-1]:
+            self._expect("{")
+            while self._peek() != "}":
+                key = self._value()
+                self._expect(":")
+                if key == name:
+                    break
+                self._value()
+                if self._expect(",}") == "}":
+                    raise KeyError(name)
+            else:
+                raise KeyError(name)
+        opening = self._expect("[{")
+        closing = "]" if opening == "[" else "}"
+        if self._peek() == closing:
+            return
+        while True:
+            key = None
+            if opening == "{":
+                key = self._value()
+                self._expect(":")
+            yield key, self._value()
+            if self._expect("," + closing) == closing:
+                return
+""".strip("\n")
+
+FILE_OPEN_FUNC = r"""
+_SUFFIXES = {{'.gz': 'gzip', '.bz2': 'bz2', '.xz': 'xz', '.lzma': 'xz', '.zst': 'zstd'}}
+
+def _sniff(path):
+    with open(path, 'rb') as f:
+        return _magic_format(f.read(6))
 
 def _open(path):
-    if path.suffix == '.gz':
-        return gzip.open(path, '{mode}')
+    fmt = {fmt}
+    if fmt == 'gzip':
+        return gzip.open(path, '{mode}'{open_opts})
+    elif fmt == 'bz2':
+        import bz2
+        return bz2.open(path, '{mode}'{open_opts})
+    elif fmt == 'xz':
+        import lzma
+        return lzma.open(path, '{mode}'{open_opts})
+    elif fmt == 'zstd':
+        try:
+            from compression.zstd import open as zstd_open
+        except ImportError:
+            from zstandard import open as zstd_open
+        return zstd_open(path, '{mode}'{open_opts})
     else:
-        return open(path, '{mode}')
+        return open(path, '{mode}'{open_opts})
+""".strip("\n")
+
+FILE_PREFETCH_FUNC = r"""
+def _read(path):
+    with _open(path) as file:
+        return file.read()
+
+def _prefetch(lines, workers, ordered):
+    # The files are read in a thread pool, at most 2 * workers files ahead
+    # of the loop.
+    with ThreadPoolExecutor(workers) as pool:
+        ahead = 2 * workers
+        pending = {}
+        for i, line in enumerate(lines, 1):
+            path = Path(line.rstrip('\r\n'))
+            pending[pool.submit(_read, path)] = (i, path)
+            if len(pending) >= ahead:
+                done = [next(iter(pending))] if ordered else wait(pending, return_when=FIRST_COMPLETED)[0]
+                for future in done:
+                    i, path = pending.pop(future)
+                    yield i, path, future.result()
+        for future in (list(pending) if ordered else as_completed(pending)):
+            i, path = pending[future]
+            yield i, path, future.result()
+""".strip("\n")
+
+TEMPLATE_FILE = r"""
+{imp}{io}
+
+{prelude}
 
 {pre}
 
-for i, line in enumerate(sys.stdin, 1):
-    path = Path(line.rstrip('\r\n'))
-    with _open(path) as file:
-        text = file.read()
+for {loop}:
 {loop_head}
 {loop_filter}
 {main}
@@ -130,6 +361,508 @@ for i, line in enumerate(sys.stdin, 1):
 {post}
 """
 
+TEMPLATE_PARALLEL = r"""
+{imp}{io}
+
+{prelude}
+{prepre}
+{pre}
+
+def _chunks(iterable, size):
+    start = 1
+    iterator = iter(iterable)
+    while True:
+        chunk = list(islice(iterator, size))
+        if not chunk:
+            return
+        yield start, chunk
+        start += len(chunk)
+
+def _worker(_task):
+    global {names}
+    _start, _chunk = _task
+    _stdout, sys.stdout = sys.stdout, io.StringIO(){worker_head}
+    for i, {var} in enumerate({chunk}, _start):
+{loop_start}
+{loop_head}
+{loop_filter}
+{main}
+    _text, sys.stdout = sys.stdout.getvalue(), _stdout
+    return _text, {worker_result}
+
+with multiprocessing.get_context('fork').Pool({processes}) as _pool:
+    for _text, _result in _pool.{imap}(_worker, {tasks}):
+        sys.stdout.write(_text)
+{merge}
+
+{post}
+"""
+
+TEMPLATE_BATCH = r"""
+{imp}{io}
+
+{prelude}
+{prepre}
+{pre}
+
+def _batch(_rows, i):{names}
+    rec = _columns(_rows, {kinds}, {default_kind!r})
+    r = rec  # ABBREV
+{loop_head}
+{loop_filter}
+{main}
+
+_rows = []
+for i, {var} in enumerate({source}, 1):
+{loop_start}
+    _rows.append(rec)
+    if len(_rows) == {size}:
+        _batch(_rows, i)
+        _rows = []
+if _rows:
+    _batch(_rows, i)
+
+{post}
+"""
+
+BATCH_FUNC = r"""
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+def _elementwise(op, reflected=False):
+    def method(self, other):
+        if isinstance(other, (list, array)):
+            return _Column(map(op, other, self) if reflected else map(op, self, other))
+        return _Column(op(other, v) for v in self) if reflected else _Column(op(v, other) for v in self)
+    return method
+
+class _Column(list):
+    # Without NumPy, the operators are applied elementwise as on NumPy arrays.
+    # ex) f1 + f2 -> [3, 7], f1 > 1 -> [False, True], -f1 -> [-1, -3]
+    __slots__ = ()
+    __hash__ = None
+
+    def __getitem__(self, i):
+        v = list.__getitem__(self, i)
+        return _Column(v) if isinstance(i, slice) else v
+
+    def __neg__(self):
+        return _Column(map(operator.neg, self))
+
+    def __pos__(self):
+        return _Column(map(operator.pos, self))
+
+    def __abs__(self):
+        return _Column(map(abs, self))
+
+    def __invert__(self):
+        return _Column(map(operator.invert, self))
+
+for _name in ("add", "sub", "mul", "truediv", "floordiv", "mod", "pow", "and", "or", "xor"):
+    _op = getattr(operator, f"__{_name}__")
+    setattr(_Column, f"__{_name}__", _elementwise(_op))
+    setattr(_Column, f"__r{_name}__", _elementwise(_op, True))
+    # list defines += and *= as extend and repeat.
+    setattr(_Column, f"__i{_name}__", _elementwise(_op))
+for _name in ("lt", "le", "gt", "ge", "eq", "ne"):
+    setattr(_Column, f"__{_name}__", _elementwise(getattr(operator, f"__{_name}__")))
+
+def _column(values, kind):
+    # kind: i, f, b, j (--type), c (-t) or '' (str)
+    if kind and not all(values):
+        # Empty cells and missing fields (None) are kept as in the row mode,
+        # so the other cells are converted one by one into a plain column.
+        conv = {"i": int, "f": float, "b": bool}.get(kind) or (_convert if kind == "c" else json.loads)
+        return _Column(conv(v) if v else v for v in values)
+    if kind == "c":
+        for k in ("i", "f"):
+            try:
+                return _column(values, k)
+            except ValueError:
+                pass
+        return _Column(map(_convert, values))
+    if np is not None:
+        if kind == "i":
+            return np.fromiter(map(int, values), np.int64, len(values))
+        if kind == "f":
+            return np.fromiter(map(float, values), np.float64, len(values))
+        if kind == "b":
+            return np.fromiter(map(bool, values), np.bool_, len(values))
+        if kind == "":
+            return np.array(values)
+    if kind == "i":
+        return _Column(map(int, values))
+    if kind == "f":
+        return _Column(map(float, values))
+    if kind == "b":
+        return _Column(map(bool, values))
+    if kind == "j":
+        return _Column(map(json.loads, values))
+    return _Column(values)
+
+def _columns(rows, kinds, default_kind):
+    return [_column(values, kinds.get(j, default_kind))
+            for j, values in enumerate(zip_longest(*rows))]
+
+def _is_column(v):
+    return isinstance(v, (list, array)) or np is not None and isinstance(v, np.ndarray) and v.ndim == 1
+
+def _and(mask, other):
+    if np is not None:
+        return np.logical_and(mask, other)
+    return _Column(a and b for a, b in zip(mask, other))
+
+def _select(col, mask):
+    if np is not None and isinstance(col, np.ndarray):
+        return col[np.asarray(mask, dtype=bool)]
+    if isinstance(col, array):
+        return array(col.typecode, compress(col, mask))
+    return _Column(compress(col, mask))
+
+def _batch_out(out, *vals):
+    # Columns are output row by row, and scalars are repeated on every row.
+    if len(vals) == 1 and isinstance(vals[0], list) and vals[0] and all(_is_column(v) for v in vals[0]):
+        vals = vals[0]
+    size = max((len(v) for v in vals if _is_column(v)), default=None)
+    if size is None:
+        out(*vals)
+        return
+    cols = [(v.tolist() if np is not None and isinstance(v, np.ndarray) else v) if _is_column(v)
+            else repeat(v, size) for v in vals]
+    for row in zip(*cols):
+        out(*row)
+"""
+
+STDIN_NEWLINE_TMPL = r"""
+# The newline of sys.stdin, which splits the lines only at '\n' except on Windows.
+_STDIN_NEWLINE = None if sys.platform == 'win32' else '\n'
+""".strip("\n")
+
+READ_LINES_FUNC = r"""
+def _split_bytes(encoding):
+    # In UTF-16 and UTF-32, a b'\n' byte can be a part of another character,
+    # so the lines are split as bytes only in the ASCII-compatible encodings.
+    return '\n'.encode(encoding) == b'\n'
+
+def _read_lines(stream, size, encoding, errors):
+    if not _split_bytes(encoding):
+        yield from io.TextIOWrapper(stream, encoding, errors, newline=_STDIN_NEWLINE)
+        return
+    rest = b''
+    while True:
+        block = stream.read(size)
+        if not block:
+            break
+        if rest:
+            block = rest + block
+        end = block.rfind(b'\n') + 1
+        rest = block[end:]
+        if end:
+            yield from str(memoryview(block)[:end], encoding, errors).split('\n')[:-1]
+    if rest:
+        yield str(rest, encoding, errors)
+""".strip("\n")
+
+MMAP_LINES_FUNC = r"""
+def _mmap_lines(stream, size, encoding, errors):
+    st = os.fstat(stream.fileno())
+    if not S_ISREG(st.st_mode) or st.st_size <= stream.tell() or not _split_bytes(encoding):
+        yield from _read_lines(stream, size, encoding, errors)
+        return
+    with mmap.mmap(stream.fileno(), 0, access=mmap.ACCESS_READ) as mm, memoryview(mm) as mv:
+        pos, end = stream.tell(), len(mm)
+        while pos < end:
+            nl = mm.rfind(b'\n', pos, pos + size) + 1 or mm.find(b'\n', pos + size) + 1 or end
+            text = str(mv[pos:nl], encoding, errors)
+            lines = text.split('\n')
+            if text.endswith('\n'):
+                lines.pop()
+            yield from lines
+            pos = nl
+""".strip("\n")
+
+MMAP_TASKS_FUNC = r"""
+def _mmap_stdin(stream, encoding):
+    st = os.fstat(stream.fileno())
+    if not S_ISREG(st.st_mode) or st.st_size <= stream.tell() or not _split_bytes(encoding):
+        return None
+    return mmap.mmap(stream.fileno(), 0, access=mmap.ACCESS_READ)
+
+def _mmap_tasks(stream, size, encoding, errors, chunk_size, count):
+    if _mm is None:
+        # _stdin, from which the header may have been read.
+        yield from _chunks(_stdin, chunk_size)
+        return
+    # Split the mapped file into byte ranges at line boundaries. The workers
+    # inherit the mapping, so only the offsets are sent to them.
+    start, pos, end = 1, stream.tell(), len(_mm)
+    while pos < end:
+        nl = _mm.find(b'\n', min(pos + size, end) - 1) + 1 or end
+        yield start, (pos, nl)
+        if count:
+            start += _mm[pos:nl].count(b'\n')
+        pos = nl
+
+def _mmap_range(chunk, encoding={encoding}, errors={errors}):
+    if not isinstance(chunk, tuple):
+        return chunk
+    text = str(memoryview(_mm)[chunk[0]:chunk[1]], encoding, errors)
+    lines = text.split('\n')
+    if text.endswith('\n'):
+        lines.pop()
+    return lines
+
+# Map the file before the workers are forked so that they share the mapping.
+_mm = _mmap_stdin(sys.stdin.buffer, {encoding})
+""".strip("\n")
+
+DECOMPRESS_FUNC = r"""
+_MAGIC = ((b'\x1f\x8b', 'gzip'), (b'BZh', 'bz2'), (b'\xfd7zXZ\x00', 'xz'), (b'\x28\xb5\x2f\xfd', 'zstd'))
+
+def _magic_format(head):
+    return next((fmt for magic, fmt in _MAGIC if head.startswith(magic)), None)
+
+class _Pushback(io.RawIOBase):
+    # A stream whose first bytes have been read to detect the format.
+
+    def __init__(self, head, stream):
+        self.head = head
+        self.stream = stream
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        if not self.head:
+            data = self.stream.read(len(b))
+        else:
+            data, self.head = self.head[:len(b)], self.head[len(b):]
+        b[:len(data)] = data
+        return len(data)
+
+def _decompress(stream, fmt):
+    # Multi-member gzip and multi-stream bz2/xz/zstd are read to the end.
+    if fmt == 'auto':
+        # A pipe may return fewer bytes than the magic numbers in one read.
+        head = b''
+        while len(head) < 6:
+            data = stream.read(6 - len(head))
+            if not data:
+                break
+            head += data
+        fmt = _magic_format(head)
+        stream = io.BufferedReader(_Pushback(head, stream), {size})
+    if fmt == 'gzip':
+        import gzip
+        stream = gzip.GzipFile(fileobj=stream, mode='rb')
+    elif fmt == 'bz2':
+        import bz2
+        stream = bz2.BZ2File(stream)
+    elif fmt == 'xz':
+        import lzma
+        stream = lzma.LZMAFile(stream)
+    elif fmt == 'zstd':
+        try:
+            from compression.zstd import ZstdFile
+            stream = ZstdFile(stream)
+        except ImportError:
+            import zstandard
+            stream = zstandard.ZstdDecompressor().stream_reader(stream, read_across_frames=True)
+    else:
+        return stream
+    return io.BufferedReader(stream, {size})
+""".strip("\n")
+
+OUTPUT_TMPL = r"""
+class _Output:
+
+    def __init__(self, stream, size, line_buffering=False):
+        self.stream = stream
+        self.size = size
+        self.line_buffering = line_buffering
+        self.buf = []
+        self.length = 0
+
+    def __getattr__(self, name):
+        return getattr(self.stream, name)
+
+    def write(self, s):
+        self.buf.append(s)
+        self.length += len(s)
+        if self.length >= self.size or (self.line_buffering and "\n" in s):
+            self.flush()
+        return len(s)
+
+    def writeln(self, s):
+        s += "\n"
+        self.buf.append(s)
+        self.length += len(s)
+        if self.length >= self.size or self.line_buffering:
+            self.flush()
+
+    def flush(self):
+        if self.buf:
+            data = "".join(self.buf)
+            self.buf.clear()
+            self.length = 0
+            self.stream.write(data)
+        self.stream.flush()
+
+    def close(self):
+        atexit.unregister(self.close)
+        try:
+            self.flush()
+        except BrokenPipeError:
+            pass
+        if sys.stdout is self:
+            sys.stdout = self.stream
+
+sys.stdout = _out = _Output(sys.stdout, {size}, sys.stdout.isatty() or getattr(sys.stdout, "line_buffering", False))
+_writeln = _out.writeln
+atexit.register(_out.close)
+""".strip("\n")
+
+STATS_TMPL = r"""
+class _StatsReader:
+    # Counts the bytes and lines read from the binary standard input.
+
+    def __init__(self, stream, stats):
+        self.stream = stream
+        self.stats = stats
+
+    def __getattr__(self, name):
+        return getattr(self.stream, name)
+
+    @property
+    def closed(self):
+        # Checked by the text layer on every line.
+        return self.stream.closed
+
+    def _count(self, b):
+        if b:
+            self.stats.bytes_in += len(b)
+            self.stats.records_in += b.count(b'\n')
+            self.stats.last = b[-1:]
+        return b
+
+    def read(self, size=-1):
+        return self._count(self.stream.read(size))
+
+    def read1(self, size=-1):
+        return self._count(self.stream.read1(size))
+
+    def readline(self, size=-1):
+        return self._count(self.stream.readline(size))
+
+    def readinto(self, b):
+        n = self.stream.readinto(b)
+        self._count(bytes(memoryview(b)[:n]))
+        return n
+
+    def readinto1(self, b):
+        n = self.stream.readinto1(b)
+        self._count(bytes(memoryview(b)[:n]))
+        return n
+
+
+# str.isascii is available from Python 3.7.
+_isascii = getattr(str, "isascii", None) or (lambda s: len(s.encode("utf-8", "surrogatepass")) == len(s))
+
+
+class _StatsWriter:
+    # Counts the bytes and lines written to the standard output, either
+    # below the text layer (binary stream) or above it (text stream).
+
+    def __init__(self, stream, stats):
+        self.stream = stream
+        self.stats = stats
+        self.text = isinstance(stream, io.TextIOBase)
+        self.newline = '\n' if self.text else b'\n'
+        self.encoding_errors = (getattr(stream, 'encoding', None) or 'utf-8', getattr(stream, 'errors', None) or 'strict')
+
+    def __getattr__(self, name):
+        return getattr(self.stream, name)
+
+    @property
+    def closed(self):
+        return self.stream.closed
+
+    def write(self, data):
+        if self.text and not _isascii(data):
+            self.stats.bytes_out += len(data.encode(*self.encoding_errors))
+        else:
+            self.stats.bytes_out += len(data)
+        self.stats.records_out += data.count(self.newline)
+        return self.stream.write(data)
+
+
+class _Stats:
+
+    def __init__(self, fmt, interval, filtered, header):
+        self.fmt = fmt
+        # The header line of -H is read but is not a record.
+        self.header = header
+        self.records_in = self.bytes_in = self.records_out = self.bytes_out = 0
+        self.filtered = 0 if filtered else None
+        self.last = b'\n'
+        self.start, self.cpu_start = time.perf_counter(), time.process_time()
+        if hasattr(sys.stdin, 'detach'):
+            stdin = sys.stdin
+            sys.stdin = io.TextIOWrapper(
+                _StatsReader(stdin.detach(), self), stdin.encoding, stdin.errors, newline=_STDIN_NEWLINE)
+        if sys.stdout is sys.__stdout__ and hasattr(sys.stdout, 'detach'):
+            # Count the blocks written by the text layer, so that print()
+            # is not slowed down. Replaced streams such as the pager are
+            # wrapped as they are.
+            stdout = sys.stdout
+            sys.stdout = io.TextIOWrapper(
+                _StatsWriter(stdout.detach(), self), stdout.encoding, stdout.errors, line_buffering=stdout.line_buffering)
+            self.stdout = None
+        else:
+            sys.stdout = self.stdout = _StatsWriter(sys.stdout, self)
+        self.stop = threading.Event()
+        if interval:
+            threading.Thread(target=self.progress, args=(interval,), daemon=True).start()
+        atexit.register(self.close)
+
+    def values(self):
+        wall = time.perf_counter() - self.start
+        # A last line without a line break is a record too.
+        records_in = max(self.records_in + (self.last != b'\n') - self.header, 0)
+        return {
+            'records_in': records_in, 'filtered': self.filtered, 'records_out': self.records_out,
+            'bytes_in': self.bytes_in, 'bytes_out': self.bytes_out,
+            'wall': round(wall, 3), 'cpu': round(time.process_time() - self.cpu_start, 3),
+            'rate': round(records_in / wall, 1) if wall else 0.0,
+        }
+
+    def report(self, kind):
+        values = self.values()
+        if self.fmt == 'json':
+            line = json.dumps({'type': kind, **values})
+        else:
+            units = {'wall': 's', 'cpu': 's', 'rate': '/s'}
+            line = f'# {kind.upper()} ' + ' '.join(f'{k}={v}{units.get(k, "")}' for k, v in values.items() if v is not None)
+        print(line, file=sys.stderr, flush=True)
+
+    def progress(self, interval):
+        while not self.stop.wait(interval):
+            self.report('progress')
+
+    def close(self):
+        atexit.unregister(self.close)
+        self.stop.set()
+        try:
+            sys.stdout.flush()
+        except BrokenPipeError:
+            pass
+        if sys.stdout is self.stdout:
+            sys.stdout = self.stdout.stream
+        self.report('stats')
+""".strip("\n")
+
 PRINT_FUNC = r"""
 def _print(*args, sep='{sep}'):
     if len(args) == 1 and isinstance(args[0], (list, tuple)):
@@ -140,7 +873,7 @@ def _print(*args, sep='{sep}'):
 
 PRINT_FUNC_JSON = r"""
 def _print(*args, sep='{sep}'):
-    print(sep.join(json.dumps(v) for v in args))
+    print(sep.join({dumps}(v) for v in args))
 """
 
 PRINT_FUNC_NATIVE = r"_print = partial(print, sep='{sep}')"
@@ -151,6 +884,62 @@ FORMAT_PRINT_FUNC = {
     "native": PRINT_FUNC_NATIVE, "n": PRINT_FUNC_NATIVE,
 }
 
+JSON_BACKENDS = {
+    "orjson": r"""
+from orjson import loads as _json_loads, dumps as _orjson_dumps
+
+def _json_dumps(v):
+    return _orjson_dumps(v).decode()
+""",
+    "ujson": r"""
+from ujson import loads as _json_loads, dumps as _json_dumps
+""",
+    "simdjson": r"""
+import simdjson
+from json import dumps as _json_dumps
+_json_parser = simdjson.Parser()
+
+def _json_plain(v):
+    if isinstance(v, simdjson.Object):
+        return v.as_dict()
+    if isinstance(v, simdjson.Array):
+        return v.as_list()
+    return v
+
+def _json_loads(s):
+    return _json_plain(_json_parser.parse(s))
+""",
+    "auto": r"""
+try:
+    from orjson import loads as _json_loads, dumps as _orjson_dumps
+
+    def _json_dumps(v):
+        return _orjson_dumps(v).decode()
+except ImportError:
+    try:
+        from ujson import loads as _json_loads, dumps as _json_dumps
+    except ImportError:
+        from json import loads as _json_loads, dumps as _json_dumps
+""",
+}
+
+JSON_PROJECT_FUNC = r"""
+_MISSING = object()
+
+def _json_project(s, keys):
+    # Only the values of the keys are converted to Python objects.
+    # The document must not be referenced when the next one is parsed.
+    doc = _json_parser.parse(s)
+    if not isinstance(doc, simdjson.Object):
+        return _json_plain(doc)
+    dic = {}
+    for k in keys:
+        v = doc.get(k, _MISSING)
+        if v is not _MISSING:
+            dic[k] = _json_plain(v)
+    return dic
+"""
+
 CONVERT_FUNC = r"""
 PATTERN_NUMERIC = re.compile(r'^[\d.-]+$')
 CONV_DIC = {"true": True, "false": False, "none": None, "null": None}
@@ -174,12 +963,209 @@ def _convert(val):
     return val
 """
 
+HEADER_INDEX_FUNC = r"""
+class _MissingKey:
+    # Raises KeyError like dic[KEY] when it is used as an index.
+
+    def __init__(self, key):
+        self.key = key
+
+    def __index__(self):
+        raise KeyError(self.key)
+
+
+def _header_indexes(header, keys, strict=False):
+    # The last column wins when names are duplicated, as in dict(zip(header, rec)).
+    index = {k: n for n, k in enumerate(header)}
+    if strict:
+        return [index[k] for k in keys]
+    return [index[k] if k in index else _MissingKey(k) for k in keys]
+""".strip("\n")
+
+INFER_FUNC = r"""
+_numeric = PATTERN_NUMERIC.match
+# Matches the values that _convert may convert (and possibly a few more).
+# None of them starts with one of _PLAIN_STARTS, which is checked first.
+_convertible = re.compile(r'[\d.-]+$|[{[(]|(?:true|false|none|null)$', re.IGNORECASE).match
+_PLAIN_STARTS = frozenset("abcdeghijklmopqrsuvwxyzABCDEGHIJKLMOPQRSUVWXYZ")
+
+def _bad(val):
+    raise ValueError(val)
+
+class _RecConverter:
+    # Converts the first records with _convert and records the type of each
+    # column. Then it compiles one direct conversion per column, and falls
+    # back to _convert for the records it cannot convert. A direct
+    # conversion either gives the result of _convert or raises.
+
+    def __init__(self, sample):
+        self.sample = sample
+        self.kinds = None
+        self.size = None
+        self.fast = None
+
+    def __call__(self, rec):
+        if self.fast is not None:
+            if len(rec) == self.size:
+                try:
+                    return self.fast(rec)
+                except (ValueError, KeyError, AttributeError):
+                    pass
+            return [_convert(v) for v in rec]
+        rec = [_convert(v) for v in rec]
+        if self.kinds is None:
+            self.size = len(rec)
+            self.kinds = [set() for _ in rec]
+        if len(rec) == self.size:
+            for kinds, v in zip(self.kinds, rec):
+                kinds.add(type(v))
+            self.sample -= 1
+            if self.sample <= 0:
+                self._compile()
+        return rec
+
+    def _compile(self):
+        # ex) return [int(rec[0]) if rec[0].isdigit() or _numeric(rec[0]) else _bad(rec[0]), ...]
+        # isdigit() also accepts a few digits that int() and float() reject,
+        # which then fall back to _convert.
+        convs = []
+        for j, kinds in enumerate(self.kinds):
+            v = f"rec[{j}]"
+            if kinds == {int}:
+                convs.append(f"int({v}) if {v}.isdigit() or _numeric({v}) else _bad({v})")
+            elif kinds <= {int, float}:
+                # int() fails on a numeric value only when it has a dot, so
+                # this is the same as trying int first as _convert does.
+                convs.append(f"(float({v}) if '.' in {v} else int({v}))"
+                             f" if {v}.replace('.', '', 1).isdigit() or _numeric({v}) else _bad({v})")
+            elif kinds == {str}:
+                # A value that _convert would convert is left to it.
+                convs.append(f"{v} if {v}[:1] in _PLAIN_STARTS or not _convertible({v}) else _bad({v})")
+            elif kinds <= {bool, type(None)}:
+                convs.append(f"CONV_DIC[{v}.lower()]")
+            else:
+                convs.append(f"_convert({v})")
+        namespace = {}
+        exec(f"def fast(rec): return [{', '.join(f'({c})' for c in convs)}]", globals(), namespace)
+        self.fast = namespace["fast"]
+"""
+
 COUNTER_POST = r"""
 for v, c in counter.most_common():
     v = "\t".join(str(x) for x in v) if isinstance(v, (list, set, tuple)) else v
     print(f"{v}\t{c}")
 """.lstrip()
 
+SPACE_SAVING_TMPL = r"""
+class SpaceSaving:
+    # Approximate counter that keeps at most 2 * capacity keys.
+    # A count is overestimated by at most self.floor.
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.counts = {}
+        self.floor = 0
+
+    def __getitem__(self, key):
+        return self.counts.get(key, self.floor)
+
+    def __setitem__(self, key, value):
+        self.counts[key] = value
+        if len(self.counts) >= 2 * self.capacity:
+            self._prune()
+
+    def _prune(self):
+        items = sorted(self.counts.items(), key=itemgetter(1), reverse=True)
+        if len(items) > self.capacity:
+            self.floor = max(self.floor, items[self.capacity][1])
+        self.counts = dict(items[:self.capacity])
+
+    def clear(self):
+        self.counts.clear()
+        self.floor = 0
+
+    def update(self, other):
+        keys = self.counts.keys() | other.counts.keys()
+        self.counts = {
+            k: self.counts.get(k, self.floor) + other.counts.get(k, other.floor) for k in keys
+        }
+        self.floor += other.floor
+        if len(self.counts) > self.capacity:
+            self._prune()
+
+    def most_common(self, n=None):
+        if n is None:
+            return sorted(self.counts.items(), key=itemgetter(1), reverse=True)
+        return heapq.nlargest(n, self.counts.items(), key=itemgetter(1))
+""".strip("\n")
+
+HYPER_LOG_LOG_TMPL = r"""
+class HyperLogLog:
+    # Approximate distinct counter using 2 ** precision registers.
+    # The standard error is about 1.04 / sqrt(2 ** precision).
+
+    def __init__(self, precision):
+        self.p = precision
+        self.m = 1 << precision
+        self.registers = bytearray(self.m)
+
+    def __getitem__(self, key):
+        return 0
+
+    def __setitem__(self, key, value):
+        # Mix the hash so that small integers are spread over all registers.
+        h = hash(key) & 0xFFFFFFFFFFFFFFFF
+        h = ((h ^ (h >> 33)) * 0xFF51AFD7ED558CCD) & 0xFFFFFFFFFFFFFFFF
+        h = ((h ^ (h >> 33)) * 0xC4CEB9FE1A85EC53) & 0xFFFFFFFFFFFFFFFF
+        h ^= h >> 33
+        j = h >> (64 - self.p)
+        rank = 65 - self.p - (h & ((1 << (64 - self.p)) - 1)).bit_length()
+        if rank > self.registers[j]:
+            self.registers[j] = rank
+
+    def clear(self):
+        self.registers = bytearray(self.m)
+
+    def update(self, other):
+        self.registers = bytearray(map(max, self.registers, other.registers))
+
+    def count(self):
+        alpha = 0.7213 / (1 + 1.079 / self.m)
+        estimate = alpha * self.m * self.m / sum(2.0 ** -r for r in self.registers)
+        zeros = self.registers.count(0)
+        if estimate <= 2.5 * self.m and zeros:
+            estimate = self.m * math.log(self.m / zeros)
+        return round(estimate)
+
+    def most_common(self, n=None):
+        return [("distinct", self.count())]
+""".strip("\n")
+
+GROUP_BY_FUNC = r"""
+def _num(v):
+    if isinstance(v, (int, float)):
+        return v
+    try:
+        return int(v)
+    except ValueError:
+        return float(v)
+
+def _val(v):
+    try:
+        return _num(v)
+    except (TypeError, ValueError):
+        return v
+""".strip("\n")
+
+GROUP_BY_POST = r"""
+_rows = [(k, _values(acc)) for k, acc in groups.items()]
+for k, vals in {order}:
+    k = "\t".join(str(x) for x in k) if isinstance(k, (list, set, tuple)) else k
+    print(k, *vals, sep="\t")
+""".strip("\n")
+
+AGG_INITS = {"count": ["0"], "sum": ["0"], "min": ["None"], "max": ["None"], "mean": ["0", "0"]}
+
 
 VIEW_TMPL = r"""
 CLEAR = '\033[0m'
@@ -196,61 +1182,156 @@ nocolor = partial(color, color_code=None)
 cyan = partial(color, color_code=CYAN)
 green = partial(color, color_code=GREEN)
 
+_SCALARS = {str, int, float, bool, type(None)}
+# str.isascii is available from Python 3.7.
+_isascii = getattr(str, "isascii", None) or (lambda s: len(s.encode("utf-8", "surrogatepass")) == len(s))
+
 class Viewer:
 
-    def __init__(self, colored=True):
+    def __init__(self, colored=True, sample=100):
         self.num = 1
         self.color1, self.color2 = (cyan, green) if colored else (nocolor, nocolor)
+        self.widths = {}
+        self.headers = None
+        # --view-table: the rows kept to size the columns, then the widths.
+        self.sample = sample
+        self.rows = []
+        self.table_headers = None
+        self.columns = None
 
     def wlen(self, w):
-        return sum(2 if east_asian_width(c) in "FWA" else 1 for c in w)
+        if _isascii(w):
+            return len(w)
+        n = self.widths.get(w)
+        if n is None:
+            if len(self.widths) >= 100000:
+                self.widths.clear()
+            n = self.widths[w] = sum(2 if east_asian_width(c) in "FWA" else 1 for c in w)
+        return n
 
     def ljust(self, w, length):
         return w + " " * max(length - self.wlen(w), 0)
 
     def format(self, val):
+        t = type(val)
+        if t in _SCALARS:
+            return str(val)
         if isinstance(val, (dict, list, tuple, set)):
+            # pformat returns the repr of a short list or tuple of scalars.
+            if t is list or t is tuple:
+                rep = repr(val)
+                if len(rep) <= 120 and all(type(v) in _SCALARS for v in val):
+                    return rep
             return pformat(val, indent=1, width=120)
         return str(val)
 
-    def _view(self, vals):
+    def _view(self, vals, lines):
         num_width = len(str(len(vals)))
         tmpl = rf"{{0:<{num_width}}}  {{1}}"
         for i, val in enumerate(vals, 1):
             for j, line in enumerate(self.format(val).split("\n")):
                 if j == 0:
-                    print(tmpl.format(i, self.color2(line)))
+                    lines.append(tmpl.format(i, self.color2(line)))
                 else:
-                    print(tmpl.format('.', self.color2(line)))
-
-    def _view_with_headers(self, vals, headers):
+                    lines.append(tmpl.format('.', self.color2(line)))
+
+    def _header_cells(self, headers):
+        # The padded headers are computed once as long as they do not change.
+        if headers != self.headers:
+            self.headers = list(headers)
+            header_width = max(self.wlen(h) for h in headers)
+            self.header_cells = [self.ljust(h, header_width) for h in headers]
+            self.header_blank = " " * header_width
+        return self.header_cells
+
+    def _view_with_headers(self, vals, headers, lines):
         num_width = len(str(len(vals)))
-        header_width = max(self.wlen(h) for h in headers)
+        cells = self._header_cells(headers)
         tmpl = rf"{{0:<{num_width}}} | {{1}} | {{2}}"
-        for i, (header, val) in enumerate(zip(headers, vals), 1):
+        for i, (cell, val) in enumerate(zip(cells, vals), 1):
             for j, line in enumerate(self.format(val).split("\n")):
                 if j == 0:
-                    print(tmpl.format(i, self.ljust(header, header_width), self.color2(line)))
+                    lines.append(tmpl.format(i, cell, self.color2(line)))
                 else:
-                    print(tmpl.format('', self.ljust('', header_width), self.color2(line)))
+                    lines.append(tmpl.format('', self.header_blank, self.color2(line)))
 
     def view(self, *args, recnum=None, headers=None):
-        print(self.color1(f'[Record {recnum or self.num}]', bold=True))
+        lines = [self.color1(f'[Record {recnum or self.num}]', bold=True)]
         vals = args[0] if len(args) == 1 and isinstance(args[0], (list, tuple)) else args
         if headers and len(vals) == len(headers):
-            self._view_with_headers(vals, headers)
+            self._view_with_headers(vals, headers, lines)
         else:
-            self._view(vals)
-        print()
+            self._view(vals, lines)
+        lines.append("")
+        print("\n".join(lines))
         self.num += 1
+
+    def _table_line(self, cells, color):
+        # The padding is outside of the colors, and the last cell has none.
+        widths, last = self.columns, len(cells) - 1
+        return " | ".join(
+            color(c) + (" " * (widths[k] - self.wlen(c)) if k < last and k < len(widths) else "")
+            for k, c in enumerate(cells)
+        )
+
+    def _flush_table(self):
+        # The widths of the columns are taken from the sampled rows (and the
+        # headers); the rows after them are streamed with these widths.
+        rows, self.rows = self.rows, []
+        headers = self.table_headers
+        ncols = max([len(cells) for _, cells in rows] + [len(headers) - 1 if headers else 0])
+        columns = [0] * (ncols + 1)
+        for cells in ([headers] if headers else []) + [[num, *cells] for num, cells in rows]:
+            for k, c in enumerate(cells):
+                columns[k] = max(columns[k], self.wlen(c))
+        self.columns = columns
+        if headers:
+            print(self._table_line(headers, partial(self.color1, bold=True)))
+        for num, cells in rows:
+            print(self._table_line([num, *cells], self.color2))
+
+    def table(self, *args, recnum=None, headers=None):
+        vals = args[0] if len(args) == 1 and isinstance(args[0], (list, tuple)) else args
+        # One line per record: the containers are not broken into lines.
+        cells = [
+            str(v).replace("\n", "\\n") if type(v) in _SCALARS else saferepr(v)
+            for v in vals
+        ]
+        num = str(recnum or self.num)
+        self.num += 1
+        if self.columns is not None:
+            print(self._table_line([num, *cells], self.color2))
+            return
+        if headers and len(vals) == len(headers) and self.table_headers is None:
+            self.table_headers = ["#", *headers]
+        self.rows.append((num, cells))
+        if len(self.rows) >= self.sample:
+            self._flush_table()
+
+    def close(self):
+        if self.rows:
+            self._flush_table()
 """
 
 
+def get_all_codes(args):
+    codes = [
+        '\n'.join(extend_codes(getattr(args, name) or []))
+        for name in ("codes", "pre_codes", "post_codes", "loop_heads", "filters", "until")
+        if name in args
+    ]
+    if is_group_by(args):
+        codes.extend([args.group_by, args.agg])
+    return [code for code in codes if code]
+
+
 def parse_all_codes(args):
+    codes = get_all_codes(args)
+    if not codes:
+        return []
+    import ast
     code_trees = []
-    for name in ("codes", "pre_codes", "post_codes", "loop_heads", "filters"):
-        if name in args:
-            code = '\n'.join(extend_codes(getattr(args, name) or []))
+    for code in codes:
         try:
             tree = ast.parse(code)
             code_trees.append(tree)
@@ -259,19 +1340,56 @@ def parse_all_codes(args):
     return code_trees
 
 
-def check_field_variables_in_code(args):
-    pattern = re.compile(r'^f\d+$')
+def get_field_numbers(args):
+    if not args.all_code_trees:
+        return []
+    import ast
+    import re
+    pattern = re.compile(r'^f([1-9]\d*)$')
+    numbers = set()
     for tree in args.all_code_trees:
         for node in ast.walk(tree):
-            if isinstance(node, ast.Name) and pattern.match(node.id):
-                return True
-    return False
+            if isinstance(node, ast.Name):
+                m = pattern.match(node.id)
+                if m:
+                    numbers.add(int(m.group(1)))
+    return sorted(numbers)
+
+
+def check_rec_is_needed(args):
+    # Whether the whole record is used, not only the field variables.
+    # This is checked on the raw text so that codes that cannot be parsed
+    # on their own (ex. '*rec') are also taken into account.
+    codes = extend_codes(args.codes)
+    if not codes or args.field_type or args.view:
+        return True
+    import re
+    if args.header_keys is not None:
+        # The dic["KEY"] lookups read only the fields up to the last key.
+        pattern = re.compile(r'\b(rec|r|locals|vars|eval|exec)\b')
+    else:
+        pattern = re.compile(r'\b(rec|r|dic|d|locals|vars|eval|exec)\b')
+    for name in ("codes", "pre_codes", "post_codes", "loop_heads", "filters", "until"):
+        if any(pattern.search(code) for code in extend_codes(getattr(args, name) or [])):
+            return True
+    return is_group_by(args) and bool(pattern.search(f"{args.group_by} {args.agg}"))
+
+
+def get_stored_names(args):
+    import ast
+    names = set()
+    for tree in args.all_code_trees:
+        for node in ast.walk(tree):
+            if isinstance(node, ast.Name) and isinstance(node.ctx, (ast.Store, ast.Del)):
+                names.add(node.id)
+    return names
 
 
 def check_wrapping_is_need(args):
     codes = extend_codes(args.codes)
     if not codes:
         return True
+    import ast
     try:
         tree = ast.parse(codes[-1])
     except SyntaxError:
@@ -317,6 +1435,13 @@ def select_pager(args):
 
 
 def enable_pager(args):
+    import atexit
+    import io
+    import os
+    import shutil
+    import signal
+    import subprocess
+    import threading
     pager = select_pager(args)
     if shutil.which(pager.split()[0]) is None:
         return False
@@ -328,9 +1453,20 @@ def enable_pager(args):
         stat["is_exiting"] = True
         if proc:
             try:
-                proc.stdin.close()
+                sys.stdout.close()
+            except BrokenPipeError:
+                # The pager has quit. Discard what is still buffered so that
+                # the close at interpreter shutdown does not fail again.
+                if not proc.stdin.closed:
+                    devnull = os.open(os.devnull, os.O_WRONLY)
+                    os.dup2(devnull, proc.stdin.fileno())
+                    os.close(devnull)
+                    sys.stdout.close()
+            except KeyboardInterrupt:
+                pass
+            try:
                 proc.wait()
-            except (BrokenPipeError, KeyboardInterrupt):
+            except KeyboardInterrupt:
                 pass
         sys.stdout = stdout_save
 
@@ -345,18 +1481,148 @@ def enable_pager(args):
         if not stat["is_exiting"]:
             exit()
 
+    def watch():
+        # If the pager quits before the output ends, stop reading the rest
+        # of the input. The signal is sent to the main thread so that a
+        # blocking read of the standard input is interrupted too.
+        proc.wait()
+        if not stat["is_exiting"]:
+            if hasattr(signal, "pthread_kill"):
+                signal.pthread_kill(threading.main_thread().ident, signal.SIGINT)
+            else:
+                import _thread
+                _thread.interrupt_main()
+
+    # A regular file is read at full speed, so the output is written in large
+    # chunks. A pipe or a terminal may deliver the input slowly, so each line
+    # is passed to the pager as soon as it is written.
+    try:
+        from stat import S_ISREG
+        line_buffering = not S_ISREG(os.fstat(sys.stdin.fileno()).st_mode)
+    except (AttributeError, OSError, ValueError):
+        line_buffering = True
     proc = subprocess.Popen(
         pager.split(),
         stdin=subprocess.PIPE,
-        universal_newlines=True,
+        bufsize=PAGER_BUFFER_SIZE,
         start_new_session=True,
     )
-    sys.stdout = proc.stdin
+    sys.stdout = io.TextIOWrapper(
+        proc.stdin,
+        encoding=getattr(stdout_save, "encoding", None) or "utf-8",
+        errors=getattr(stdout_save, "errors", None) or "strict",
+        line_buffering=line_buffering,
+    )
     atexit.register(on_exit)
     signal.signal(signal.SIGINT, sighandler)
+    threading.Thread(target=watch, daemon=True).start()
     return True
 
 
+def cache_enabled(args):
+    if args.no_cache or args.print or args.output or args.profile or args.command == "custom":
+        return False
+    return environ.get('PYPIPE_CACHE', 'true').lower() == 'true'
+
+
+def get_cache_dir():
+    if environ.get('PYPIPE_CACHE_DIR'):
+        return expanduser(environ['PYPIPE_CACHE_DIR'])
+    return join(expanduser(environ.get('XDG_CACHE_HOME') or '~/.cache'), 'pypipe')
+
+
+def get_cache_key(args):
+    # The stat of this file is part of the key so that a modified pypipe.py
+    # never reuses code generated by the previous version. The automatic
+    # imports depend on the modules found in sys.path, so its key is too.
+    st = stat(__file__)
+    params = sorted((k, v) for k, v in vars(args).items() if k != "handler")
+    return repr((__version__, sys.executable, st.st_mtime_ns, st.st_size, get_negative_imports_key(), params))
+
+
+def get_cache_file(key):
+    # zlib is much cheaper to import than hashlib. The full key is stored
+    # in the cache file, so a collision only results in a cache miss.
+    import zlib
+    data = key.encode()
+    return join(get_cache_dir(), f"{zlib.crc32(data):08x}{zlib.adler32(data):08x}.bin")
+
+
+def load_cached_code(key):
+    cache_file = get_cache_file(key)
+    try:
+        with open(cache_file, "rb") as f:
+            cached_key, code = marshal.load(f)
+        utime(cache_file)
+    except (OSError, EOFError, ValueError, TypeError):
+        return None
+    return code if cached_key == key and isinstance(code, CodeType) else None
+
+
+def save_cached_code(key, code):
+    cache_dir = get_cache_dir()
+    cache_file = get_cache_file(key)
+    tmp_file = f"{cache_file}.{getpid()}.tmp"
+    try:
+        makedirs(cache_dir, exist_ok=True)
+        with open(tmp_file, "wb") as f:
+            marshal.dump((key, code), f)
+        replace(tmp_file, cache_file)
+        evict_cached_codes(cache_dir, keep=cache_file)
+    except OSError:
+        pass
+
+
+def evict_cached_codes(cache_dir, keep):
+    limit = int(environ.get('PYPIPE_CACHE_SIZE', CACHE_SIZE))
+    entries = [(e.stat(), e.path) for e in scandir(cache_dir) if e.name.endswith(".bin")]
+    total = sum(st.st_size for st, _ in entries)
+    # Least recently used first, since a hit touches the file.
+    for st, path in sorted(entries, key=lambda e: e[0].st_mtime_ns):
+        if total <= limit:
+            break
+        if path == keep:
+            continue
+        remove(path)
+        total -= st.st_size
+
+
+def get_negative_imports_key():
+    # Installing a package changes the mtime of its directory in sys.path,
+    # which invalidates the negative cache.
+    entries = []
+    for p in sys.path:
+        try:
+            entries.append((p, stat(p or ".").st_mtime_ns))
+        except OSError:
+            entries.append((p, None))
+    return repr((sys.version, entries))
+
+
+def load_negative_imports():
+    try:
+        with open(join(get_cache_dir(), NEGATIVE_IMPORTS_FILE), "rb") as f:
+            key, misses = marshal.load(f)
+    except (OSError, EOFError, ValueError, TypeError):
+        return []
+    return list(misses) if key == get_negative_imports_key() else []
+
+
+def save_negative_imports(misses):
+    # misses are ordered from the least recently missed, which are dropped first.
+    cache_dir = get_cache_dir()
+    cache_file = join(cache_dir, NEGATIVE_IMPORTS_FILE)
+    tmp_file = f"{cache_file}.{getpid()}.tmp"
+    misses = list(misses)[-NEGATIVE_IMPORTS_SIZE:]
+    try:
+        makedirs(cache_dir, exist_ok=True)
+        with open(tmp_file, "wb") as f:
+            marshal.dump((get_negative_imports_key(), misses), f)
+        replace(tmp_file, cache_file)
+    except OSError:
+        pass
+
+
 def indent(code, level=1):
     return INDENT * level + code
 
@@ -391,11 +1657,142 @@ def _exec_code(code, args):
     elif args.print:
         print(code)
     else:
-        _globals = {
-            '__name__': '__exec__',
-            '__builtins__': globals()['__builtins__']
-        }
-        exec(compile(code, '<string>', 'exec'), _globals)
+        if not isinstance(code, CodeType) and not args.profile:
+            code = compile(code, '<string>', 'exec')
+            if args.cache_key:
+                save_cached_code(args.cache_key, code)
+        # Register the generated code as a module so that functions defined
+        # in it can be pickled by reference (e.g. by the worker pool of -P).
+        module = ModuleType('__exec__')
+        module.__dict__['__builtins__'] = globals()['__builtins__']
+        sys.modules['__exec__'] = module
+        if args.profile:
+            profile_exec(code, module, args)
+            return
+        exec(code, module.__dict__)
+
+
+PROFILE_INTERVAL = 0.001
+
+
+def get_code_sections(code):
+    # Maps each line of the generated code to the section it belongs to.
+    # The main loop statement and the parsing lines before # LOOP HEAD are
+    # the LOOP section.
+    import re
+    marker = re.compile(r'^\s*# (IMPORT|INPUT|OUTPUT|PRE|LOOP HEAD|LOOP FILTER|MAIN|POST)$')
+    sections, section = {}, "TEMPLATE"
+    for lineno, line in enumerate(code.split("\n"), 1):
+        m = marker.match(line)
+        if m:
+            section = m.group(1)
+        elif line.startswith(("for ", "with ", "_rows = []")) and section in ("IMPORT", "INPUT", "OUTPUT", "PRE"):
+            section = "LOOP"
+        sections[lineno] = section
+    return sections
+
+
+def get_helper_labels(code, sections):
+    # Labels the lines of the functions and classes defined outside the user
+    # sections (the helper templates such as _print) with their names.
+    import re
+    user_sections = ("LOOP HEAD", "LOOP FILTER", "MAIN", "POST")
+    definition = re.compile(r'(?:async\s+)?(?:def|class)\s+(\w+)')
+    labels, helper = dict(sections), None
+    for lineno, line in enumerate(code.split("\n"), 1):
+        if line[:1].strip() and not line.startswith(("#", "@")):
+            m = definition.match(line)
+            helper = m.group(1) if m and sections[lineno] not in user_sections else None
+        if helper:
+            labels[lineno] = helper
+    return labels
+
+
+def profile_exec(source, module, args):
+    import linecache
+    import signal
+    import threading
+    from time import perf_counter
+    # A pseudo-filename that the profilers and tracebacks can resolve.
+    filename = f"<pypipe {args.command}>"
+    lines = source.splitlines(True)
+    linecache.cache[filename] = (len(source), None, lines, filename)
+    code = compile(source, filename, 'exec')
+    sections = get_code_sections(source)
+    labels = get_helper_labels(source, sections)
+    user_sections = ("LOOP HEAD", "LOOP FILTER", "MAIN", "POST")
+    section_samples, line_samples = {}, {}
+    main_id = threading.get_ident()
+    stop = threading.Event()
+
+    def record(frame):
+        linenos = []
+        while frame is not None:
+            if frame.f_code.co_filename == filename:
+                linenos.append(frame.f_lineno)
+            frame = frame.f_back
+        if not linenos:
+            return
+        # The time of the helper functions is counted in the section
+        # of the line calling them; user sections take priority.
+        linenos.reverse()
+        section = next((sections[n] for n in linenos if sections[n] in user_sections), sections[linenos[0]])
+        section_samples[section] = section_samples.get(section, 0) + 1
+        line_samples[linenos[-1]] = line_samples.get(linenos[-1], 0) + 1
+
+    def sample():
+        # Fallback without setitimer. A thread only gets the GIL when the
+        # main thread releases it, so it is biased towards I/O.
+        while not stop.wait(PROFILE_INTERVAL):
+            record(sys._current_frames().get(main_id))
+
+    # The sampler is not used with cProfile, whose numbers it would distort.
+    profiler = sampler = None
+    use_timer = False
+    if args.profile == "cprofile":
+        import cProfile
+        profiler = cProfile.Profile()
+    elif hasattr(signal, "setitimer"):
+        # The CPU time timer interrupts the main thread at any bytecode.
+        use_timer = True
+        handler = signal.signal(signal.SIGPROF, lambda signum, frame: record(frame))
+        signal.setitimer(signal.ITIMER_PROF, PROFILE_INTERVAL, PROFILE_INTERVAL)
+    else:
+        sampler = threading.Thread(target=sample, daemon=True)
+        sampler.start()
+    start = perf_counter()
+    try:
+        if profiler:
+            profiler.runctx(code, module.__dict__, module.__dict__)
+        else:
+            exec(code, module.__dict__)
+    finally:
+        elapsed = perf_counter() - start
+        if use_timer:
+            signal.setitimer(signal.ITIMER_PROF, 0)
+            signal.signal(signal.SIGPROF, handler)
+        elif sampler:
+            stop.set()
+            sampler.join()
+        sys.stdout.flush()
+        out = sys.stderr
+        if profiler:
+            print(f"# PROFILE ({args.profile}, {elapsed:.3f}s)", file=out)
+            import pstats
+            stats = pstats.Stats(profiler, stream=out)
+            stats.sort_stats("tottime").print_stats(15)
+            if args.profile_output:
+                stats.dump_stats(args.profile_output)
+        else:
+            total = sum(section_samples.values())
+            print(f"# PROFILE ({args.profile}, {elapsed:.3f}s, {total} samples)", file=out)
+            print(f"{'SECTION':<12}{'TIME':>10}{'%':>8}", file=out)
+            for section, n in sorted(section_samples.items(), key=lambda kv: -kv[1]):
+                print(f"{section:<12}{elapsed * n / total:>9.3f}s{100 * n / total:>7.1f}%", file=out)
+            print(f"{'LINE':>6}  {'SECTION':<16}{'%':>6}  CODE", file=out)
+            for lineno, n in sorted(line_samples.items(), key=lambda kv: -kv[1])[:10]:
+                print(f"{lineno:>6}  {labels[lineno]:<16}{100 * n / total:>5.1f}%  {lines[lineno - 1].strip()}",
+                      file=out)
 
 
 def exec_code(code, args):
@@ -421,34 +1818,220 @@ def is_json_needed(args):
             "field_type" in args and "j" in list(args.field_type.values()))
 
 
+def json_func(args, name):
+    return f"json.{name}" if args.json_backend == "stdlib" else f"_json_{name}"
+
+
+def get_subscript_key(node):
+    # The key of dic["KEY"], or None if it is not a constant string.
+    import ast
+    key = node.slice
+    if sys.version_info < (3, 9) and isinstance(key, ast.Index):
+        key = key.value
+    if sys.version_info < (3, 8) and isinstance(key, ast.Str):
+        return key.s
+    if isinstance(key, ast.Constant) and isinstance(key.value, str):
+        return key.value
+    return None
+
+
+def get_bound_name(node):
+    # The name bound by a parameter, a def, a class, an except clause or an
+    # import. Such a name may hide dic or rec in its scope.
+    import ast
+    if isinstance(node, ast.arg):
+        return node.arg
+    if isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef, ast.ClassDef, ast.ExceptHandler)):
+        return node.name
+    if isinstance(node, ast.alias):
+        return (node.asname or node.name).split(".")[0]
+    return None
+
+
+def get_dic_keys(args):
+    # The keys read as dic["KEY"] (or d["KEY"]), or None if dic is used in
+    # any other way: passed around, iterated, assigned, indexed with a
+    # non-constant key or hidden by a parameter of the same name.
+    if args.view or len(args.all_code_trees) != len(get_all_codes(args)):
+        return None
+    import ast
+    keys = set()
+    for tree in args.all_code_trees:
+        subscripted = set()
+        for node in ast.walk(tree):
+            if (isinstance(node, ast.Subscript) and isinstance(node.value, ast.Name)
+                    and node.value.id in ("dic", "d") and isinstance(node.ctx, ast.Load)):
+                key = get_subscript_key(node)
+                if key is None:
+                    return None
+                keys.add(key)
+                subscripted.add(id(node.value))
+        for node in ast.walk(tree):
+            if isinstance(node, ast.Name) and (
+                    node.id in ("dic", "d") and id(node) not in subscripted
+                    or node.id in ("locals", "vars", "globals", "eval", "exec")):
+                return None
+            if get_bound_name(node) in ("dic", "d"):
+                return None
+    return sorted(keys)
+
+
+def get_json_keys(args):
+    # With --json-backend simdjson, the keys read as dic["KEY"] are the
+    # only ones decoded, as long as dic is not used in any other way.
+    if args.json_backend != "simdjson" or not ("json" in args and args.json):
+        return None
+    return get_dic_keys(args)
+
+
+def get_header_keys(args):
+    # With -H, the dic["KEY"] lookups are compiled to rec[INDEX] once the
+    # header is read, so that no dict is built per record. This needs dic to
+    # hold the values of rec as they are after the loop head, so rec must
+    # not be reassigned or modified by the codes.
+    if not args.header or is_batch(args):
+        return None
+    keys = get_dic_keys(args)
+    if keys is None:
+        return None
+    import ast
+    for tree in args.all_code_trees:
+        for node in ast.walk(tree):
+            if get_bound_name(node) in ("rec", "r"):
+                # rec[_hN] would read the parameter instead.
+                return None
+            target = node.value if isinstance(node, (ast.Subscript, ast.Attribute)) else node
+            if not (isinstance(target, ast.Name) and target.id in ("rec", "r")):
+                continue
+            if isinstance(node, ast.Attribute) or isinstance(node.ctx, (ast.Store, ast.Del)):
+                return None
+    return keys
+
+
+def rewrite_header_keys(args):
+    # Replaces dic["KEY"] with rec[_hN] in the codes, where _hN is the
+    # index of KEY in the header (see get_header_keys).
+    if sys.version_info < (3, 8):
+        # The nodes have no end position to replace them by.
+        return False
+    import ast
+    import re
+    pattern = re.compile(r'\b(dic|d)\b')
+    names = {key: f"_h{n}" for n, key in enumerate(args.header_keys)}
+
+    def rewrite(code):
+        if not pattern.search(code):
+            return code
+        lines = [line.encode() for line in code.split("\n")]
+        nodes = [
+            node for node in ast.walk(ast.parse(code))
+            if isinstance(node, ast.Subscript) and isinstance(node.value, ast.Name)
+            and node.value.id in ("dic", "d")
+        ]
+        # The offsets are in bytes. Replace from the end of the code so that
+        # the offsets of the remaining nodes stay valid.
+        for node in sorted(nodes, key=lambda n: (n.lineno, n.col_offset), reverse=True):
+            first, last = lines[node.lineno - 1], lines[node.end_lineno - 1]
+            new = f"rec[{names[get_subscript_key(node)]}]".encode()
+            lines[node.lineno - 1:node.end_lineno] = [first[:node.col_offset] + new + last[node.end_col_offset:]]
+        return "\n".join(line.decode() for line in lines)
+
+    try:
+        rewritten = {
+            name: [rewrite(code) for code in getattr(args, name)]
+            for name in ("codes", "pre_codes", "post_codes", "loop_heads", "filters", "until")
+            if name in args and getattr(args, name)
+        }
+        if is_group_by(args):
+            rewritten.update(group_by=rewrite(args.group_by), agg=rewrite(args.agg))
+    except SyntaxError:
+        # A code that can only be parsed together with the others.
+        return False
+    for name, codes in rewritten.items():
+        setattr(args, name, codes)
+    if is_group_by(args):
+        args.aggregations = parse_aggregations(args.agg)
+    return True
+
+
+def gen_json_loads(args, var):
+    keys = get_json_keys(args)
+    if keys is not None:
+        return f"dic = _json_project({var}, {tuple(keys)!r})"
+    return f"dic = {json_func(args, 'loads')}({var})"
+
+
 def get_imports(args):
     imports = set()
     imports.add("sys")
     imports.add("from functools import partial")
     if args.view:
-        imports.add("from pprint import pformat")
+        imports.add("from pprint import pformat, saferepr")
         imports.add("from unicodedata import east_asian_width")
     if is_json_needed(args):
         imports.add("json")
     if args.convert:
         imports.update({"re", "json"})
-    if args.counter:
+    if args.counter and not args.approx:
         imports.add("from collections import Counter")
+    if args.approx == "heavy":
+        imports.update({"heapq", "from operator import itemgetter"})
+    if args.approx == "distinct":
+        imports.add("math")
+    if args.top is not None and is_group_by(args):
+        imports.add("heapq")
+    if args.output_buffer:
+        imports.add("atexit")
+    if is_batch(args):
+        imports.update({"operator", "from array import array", "from itertools import compress, repeat, zip_longest"})
+        if args.convert or "j" in args.field_type.values():
+            imports.add("json")
+    if "field_numbers" in args and args.field_numbers and not args.field_length:
+        imports.add("from operator import itemgetter")
     # REC
     if args.command == "rec":
         if args.regex or (args.delimiter != r'\t' and len(args.delimiter) > 1):
             imports.add("re")
+    # PARALLEL
+    if is_process_pool(args):
+        imports.update({"io", "multiprocessing", "from itertools import islice"})
+    if "reader" in args and args.reader in ("block", "mmap"):
+        imports.add("io")
+    if "reader" in args and args.reader == "mmap":
+        imports.update({"mmap", "os", "from stat import S_ISREG"})
+    if "decompress" in args and args.decompress:
+        imports.add("io")
+    if "reader" in args and args.reader == "text" and (args.encoding or args.errors):
+        imports.add("io")
+    if args.stats:
+        imports.update({"atexit", "io", "json", "threading", "time"})
     # CSV
     if args.command == "csv":
         imports.add("csv")
+    if args.command == "text" and args.stream is not None:
+        imports.update({"json", "re"})
     # FILE
     if args.command == "file":
         imports.add("gzip")
         imports.add("from pathlib import Path")
+        if args.parallel is not None and args.pool == "thread":
+            imports.add("from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, as_completed, wait")
+            if not args.parallel:
+                imports.add("os")
     return imports
 
 
+def is_process_pool(args):
+    return "parallel" in args and args.parallel is not None and not ("pool" in args and args.pool == "thread")
+
+
 def get_auto_imports(args):
+    if not args.all_code_trees:
+        return set()
+    import ast
+    import builtins
+    import importlib.util
+    import re
 
     def _trace(node):
         """
@@ -480,22 +2063,44 @@ def get_auto_imports(args):
                 ret.extend(_retrieve(node))
         return ret
 
+    def _find(modulename):
+        if modulename in misses:
+            new_misses[modulename] = None
+            return False
+        if modulename not in _found_modules:
+            try:
+                _found_modules[modulename] = importlib.util.find_spec(modulename) is not None
+            except (ModuleNotFoundError, AttributeError, ValueError):
+                _found_modules[modulename] = False
+        if not _found_modules[modulename]:
+            new_misses[modulename] = None
+        return _found_modules[modulename]
+
     def _extract_module(tree):
         candidates = set()
         for ls in _retrieve(tree):
+            # A dotted name can only be a module if its first name is one.
+            if not ls or ls[0] in local_names or field_pattern.match(ls[0]) or not _find(ls[0]):
+                continue
             for i in range(len(ls), 0, -1):
                 modulename = ".".join(ls[:i])
-                try:
-                    if importlib.util.find_spec(modulename) is not None:
-                        candidates.add(modulename)
-                        break
-                except (ModuleNotFoundError, AttributeError):
-                    continue
+                if _find(modulename):
+                    candidates.add(modulename)
+                    break
         return candidates
 
+    local_names = LOCAL_NAMES | get_stored_names(args) | set(dir(builtins))
+    field_pattern = re.compile(r'^f\d+$')
+    persist = cache_enabled(args)
+    misses = dict.fromkeys(load_negative_imports() if persist else ())
+    # The names missed in this run, including the cached ones, in order.
+    new_misses = {}
     modules = set()
     for tree in args.all_code_trees:
         modules.update(_extract_module(tree))
+    if persist and not new_misses.keys() <= misses.keys():
+        # The cached names missed again move to the end with the new ones.
+        save_negative_imports([*(m for m in misses if m not in new_misses), *new_misses])
     return modules
 
 
@@ -519,36 +2124,281 @@ def gen_import(args):
     return "\n".join(codes)
 
 
+def input_source(args):
+    return "_stdin" if "reader" in args and args.reader in ("block", "mmap") else "sys.stdin"
+
+
+def check_record_number_in_code(args):
+    if args.view:
+        return True
+    if not args.all_code_trees:
+        return False
+    import ast
+    for tree in args.all_code_trees:
+        for node in ast.walk(tree):
+            if isinstance(node, ast.Name) and node.id == "i":
+                return True
+    return False
+
+
+def gen_io(args):
+    codes = []
+    if "decompress" in args and args.decompress:
+        codes.append(DECOMPRESS_FUNC.format(size=args.block_size if "block_size" in args else 1 << 20))
+        # In file, the files are decompressed, not the list of the paths.
+        if args.command != "file":
+            encoding = repr(args.encoding) if "encoding" in args and args.encoding else "sys.stdin.encoding"
+            errors = repr(args.errors) if "errors" in args and args.errors else "sys.stdin.errors"
+            codes.append(f"_encoding, _errors = {encoding}, {errors}")
+            codes.append("sys.stdin = io.TextIOWrapper(_decompress(sys.stdin.detach(), {!r}), _encoding, _errors, newline=_STDIN_NEWLINE)".format(
+                args.decompress))
+    if "reader" in args:
+        encoding = repr(args.encoding) if args.encoding else "sys.stdin.encoding"
+        errors = repr(args.errors or "strict")
+        if args.reader == "block":
+            codes.append(READ_LINES_FUNC)
+            codes.append(f"_stdin = _read_lines(sys.stdin.buffer, {args.block_size}, {encoding}, {errors})")
+        elif args.reader == "mmap" and args.parallel is not None:
+            codes.append(READ_LINES_FUNC)
+            codes.append(MMAP_TASKS_FUNC.format(encoding=encoding, errors=errors))
+            # With _mm, only used to read the header line; the rest is split by _mmap_tasks.
+            codes.append(f"_stdin = (str(b, {encoding}, {errors}) for b in sys.stdin.buffer) if _mm is not None "
+                         f"else _read_lines(sys.stdin.buffer, {args.block_size}, {encoding}, {errors})")
+        elif args.reader == "mmap":
+            codes.append(READ_LINES_FUNC)
+            codes.append(MMAP_LINES_FUNC)
+            codes.append(f"_stdin = _mmap_lines(sys.stdin.buffer, {args.block_size}, {encoding}, {errors})")
+        elif args.encoding or args.errors:
+            # TextIOWrapper.reconfigure is available from Python 3.7.
+            codes.append(f"_encoding, _errors = {encoding}, {errors}")
+            codes.append("sys.stdin = io.TextIOWrapper(sys.stdin.detach(), _encoding, _errors, newline=_STDIN_NEWLINE)")
+    if codes:
+        codes[0:0] = ["# INPUT", STDIN_NEWLINE_TMPL]
+    if args.stats:
+        # After the decompression and before the readers and the output
+        # buffer, so that the uncompressed bytes and all writes are counted.
+        pos = next((n for n, c in enumerate(codes) if c.startswith("_stdin = ")), len(codes))
+        codes[pos:pos] = [STATS_TMPL, "_stats = _Stats({!r}, {}, {}, {})".format(
+            args.stats_format or "text", args.stats_interval, is_filter_counted(args),
+            bool("header" in args and args.header))]
+        if pos == 0:
+            codes[0:0] = ["# INPUT", STDIN_NEWLINE_TMPL]
+    if args.output_buffer:
+        codes.append("# OUTPUT")
+        codes.append(OUTPUT_TMPL.format(size=args.output_buffer))
+    if not codes:
+        return ""
+    return "\n\n" + "\n".join(codes)
+
+
+def is_group_by(args):
+    return "group_by" in args and args.group_by is not None
+
+
+def parse_aggregations(agg):
+    """
+    e.g.) 'sum(f3),max(f4),count()' -> [('sum', 'f3'), ('max', 'f4'), ('count', None)]
+    """
+    import ast
+    try:
+        tree = ast.parse(agg, mode="eval").body
+    except SyntaxError:
+        raise ValueError(f"invalid aggregation: {agg}")
+    aggs = []
+    for call in tree.elts if isinstance(tree, ast.Tuple) else [tree]:
+        if (not isinstance(call, ast.Call) or not isinstance(call.func, ast.Name)
+                or call.func.id not in AGG_INITS or call.keywords
+                or len(call.args) != (0 if call.func.id == "count" else 1)):
+            raise ValueError(f"invalid aggregation: {get_source_segment(agg, call)}")
+        aggs.append((call.func.id, get_call_argument(agg, call) if call.args else None))
+    return aggs
+
+
+def get_call_argument(source, call):
+    import ast
+    if hasattr(ast, "get_source_segment"):
+        return ast.get_source_segment(source, call.args[0])
+    # The offset of a comprehension is not where it starts before Python
+    # 3.8, so take the text between the parentheses of the call.
+    segment = get_source_segment(source, call)
+    return segment[segment.index("(") + 1:segment.rindex(")")].strip()
+
+
+def get_source_segment(source, node):
+    import ast
+    if hasattr(ast, "get_source_segment"):
+        return ast.get_source_segment(source, node)
+    # Before Python 3.8 the nodes have no end position. An expression ends
+    # at the first comma or closing bracket outside of its own brackets.
+    import io
+    import tokenize
+    line = source.splitlines(True)[node.lineno - 1]
+    start = (node.lineno, len(line.encode()[:node.col_offset].decode()))
+    depth = 0
+    end = None
+    for tok in tokenize.generate_tokens(io.StringIO(source).readline):
+        if tok.start < start:
+            continue
+        if tok.type in (tokenize.NEWLINE, tokenize.ENDMARKER) or (
+                tok.type == tokenize.OP and depth == 0 and tok.string in ",)]}"):
+            end = tok.start
+            break
+        if tok.type == tokenize.OP and tok.string in "([{":
+            depth += 1
+        elif tok.type == tokenize.OP and tok.string in ")]}":
+            depth -= 1
+    lines = source.splitlines(True)[start[0] - 1:end[0]]
+    lines[-1] = lines[-1][:end[1]]
+    lines[0] = lines[0][start[1]:]
+    return "".join(lines).strip()
+
+
+def gen_group_by_funcs(args):
+    # Each group keeps one flat list of accumulators. mean uses two slots
+    # (sum and count), all the others use one.
+    values, merges = [], []
+    j = 0
+    for func, _ in args.aggregations:
+        if func == "mean":
+            values.append(f"acc[{j}] / acc[{j + 1}] if acc[{j + 1}] else None")
+            merges.extend([f"dst[{j}] += acc[{j}]", f"dst[{j + 1}] += acc[{j + 1}]"])
+        else:
+            values.append(f"acc[{j}]")
+            if func in ("min", "max"):
+                # A group without values in a worker keeps None.
+                op = "<" if func == "min" else ">"
+                merges.append(f"if acc[{j}] is not None and (dst[{j}] is None or acc[{j}] {op} dst[{j}]): "
+                              f"dst[{j}] = acc[{j}]")
+            else:
+                merges.append(f"dst[{j}] += acc[{j}]")
+        j += len(AGG_INITS[func])
+    codes = [GROUP_BY_FUNC, "", "def _values(acc):", indent(f"return [{', '.join(values)}]")]
+    if "parallel" in args and args.parallel is not None:
+        codes.extend(["", "def _merge_groups(groups, other):"])
+        codes.extend(indent(c) for c in [
+            "for key, acc in other.items():",
+            indent("dst = groups.get(key)"),
+            indent("if dst is None:"),
+            indent("groups[key] = acc", 2),
+            indent("continue", 2),
+        ] + [indent(c) for c in merges])
+    codes.append("")
+    codes.append("groups = {}")
+    return codes
+
+
+def gen_group_by(args):
+    inits = [v for func, _ in args.aggregations for v in AGG_INITS[func]]
+    codes = [
+        f"_key = {args.group_by}",
+        "_acc = groups.get(_key)",
+        "if _acc is None:",
+        indent(f"_acc = groups[_key] = [{', '.join(inits)}]"),
+    ]
+    j = 0
+    for func, expr in args.aggregations:
+        if func == "count":
+            codes.append(f"_acc[{j}] += 1")
+            j += len(AGG_INITS[func])
+            continue
+        # Missing fields (None) and empty cells are skipped, and not counted by mean.
+        codes.append(f"_v = {expr}")
+        codes.append("if _v is not None and _v != '':")
+        if func == "sum":
+            codes.append(indent(f"_acc[{j}] += _num(_v)"))
+        elif func == "mean":
+            codes.append(indent(f"_acc[{j}] += _num(_v)"))
+            codes.append(indent(f"_acc[{j + 1}] += 1"))
+        else:
+            op = "<" if func == "min" else ">"
+            codes.append(indent("_v = _val(_v)"))
+            codes.append(indent(f"if _acc[{j}] is None or _v {op} _acc[{j}]: _acc[{j}] = _v"))
+        j += len(AGG_INITS[func])
+    return codes
+
+
 def gen_pre(args):
     codes = ["# PRE"]
     codes.append(r'_p = partial(print, sep="\t")  # ABBREV')
     codes.append(r'I, S, B, L, D, SET = 0, "", False, [], {}, set()  # ABBREV')
     if args.view:
         codes.append(VIEW_TMPL)
-        codes.append(rf"viewer = Viewer(colored={args.colored})")
-        codes.append(r"view = viewer.view")
+        if args.view_table:
+            codes.append(rf"viewer = Viewer(colored={args.colored}, sample={args.view_sample})")
+            codes.append(r"view = viewer.table")
+        else:
+            codes.append(rf"viewer = Viewer(colored={args.colored})")
+            codes.append(r"view = viewer.view")
     if args.convert:
         codes.append(CONVERT_FUNC)
-    codes.append(FORMAT_PRINT_FUNC[args.output_format].format(sep=args.output_delimiter))
-    if args.counter:
+        if "infer_types" in args and args.infer_types and not is_batch(args):
+            codes.append(INFER_FUNC)
+            codes.append(rf"_convert_rec = _RecConverter({args.infer_types})")
+    if args.json_backend != "stdlib" and is_json_needed(args):
+        codes.append(JSON_BACKENDS[args.json_backend])
+        if get_json_keys(args) is not None:
+            codes.append(JSON_PROJECT_FUNC)
+    print_func = FORMAT_PRINT_FUNC[args.output_format].format(
+        sep=args.output_delimiter, dumps=json_func(args, "dumps"))
+    if args.output_buffer:
+        # Write the formatted rows straight into the output buffer.
+        print_func = print_func.replace("    print(", "    _writeln(")
+    codes.append(print_func)
+    if is_group_by(args):
+        codes.extend(gen_group_by_funcs(args))
+    if is_batch(args):
+        codes.append(BATCH_FUNC)
+    if args.approx == "heavy":
+        codes.append(SPACE_SAVING_TMPL)
+        codes.append(rf"counter = SpaceSaving({args.capacity})")
+    elif args.approx == "distinct":
+        codes.append(HYPER_LOG_LOG_TMPL)
+        codes.append(rf"counter = HyperLogLog({args.precision})")
+    elif args.counter:
         codes.append(r"counter = Counter()")
+    if args.counter:
         codes.append(r"c = counter  #ABBREV")
+    if "head" in args and args.head:
+        codes.append(rf"_head = {args.head}")
     if args.pre_codes:
         codes.extend(extend_codes(args.pre_codes))
     return "\n".join(codes)
 
 
 def gen_post(args):
-    if args.post_codes:
-        return "\n".join(extend_codes(args.post_codes, "POST"))
     codes = ["# POST"]
-    if args.counter:
-        codes.append(COUNTER_POST)
+    if args.view_table:
+        # The table is flushed before anything the post codes print.
+        codes.append("viewer.close()")
+    if args.post_codes:
+        codes.extend(extend_codes(args.post_codes))
+    elif args.counter:
+        post = COUNTER_POST
+        if args.top is not None:
+            # most_common(n) selects the top n with a heap.
+            post = post.replace("most_common()", f"most_common({args.top})")
+        codes.append(post)
+    elif is_group_by(args):
+        # The groups without values (None) come last.
+        key = "key=lambda row: (row[1][0] is not None, row[1][0])"
+        if args.top is not None:
+            order = f"heapq.nlargest({args.top}, _rows, {key})"
+        else:
+            order = f"sorted(_rows, {key}, reverse=True)"
+        codes.append(GROUP_BY_POST.format(order=order))
+    if args.output_buffer:
+        codes.append("_out.close()")
+    if args.stats:
+        codes.append("_stats.close()")
     return "\n".join(codes)
 
 
-def gen_main(args, default_code, wrapper, level=1):
+def gen_main(args, default_code, wrapper, level=1, stop="break"):
     codes = extend_codes(args.codes, "MAIN")
+    if is_group_by(args):
+        codes.extend(gen_group_by(args))
+        codes.extend(gen_head(args, stop))
+        return "\n".join(indent(c, level=level) for c in codes)
     if len(codes) == 1:
         codes.append(default_code)  # set default code
     if not args.no_wrapping:
@@ -561,63 +2411,211 @@ def gen_main(args, default_code, wrapper, level=1):
             codes[-1] = spaces + r"counter[{}] += 1".format(codes[-1].lstrip())
         else:
             codes[-1] = spaces + wrapper.format(codes[-1].lstrip())
+    codes.extend(gen_head(args, stop))
     return "\n".join(indent(c, level=level) for c in codes)
 
 
-def gen_loop_filter(args, level=1):
+def gen_head(args, stop="break"):
+    # --head N stops the loop right after the N-th record passing the
+    # filters, so that no more input is read than needed.
+    if "head" not in args or not args.head:
+        return []
+    return ["_head -= 1", f"if not _head: {stop}"]
+
+
+def is_filter_counted(args):
+    # The records dropped in the worker processes and by the masks of
+    # --batch are not counted.
+    return bool(args.stats and "filters" in args and args.filters and not is_process_pool(args) and not is_batch(args))
+
+
+def gen_loop_filter(args, level=1, stop="break"):
     filters = ["# LOOP FILTER"]
+    # --until EXPR stops the loop before the record for which EXPR is true.
+    if "until" in args and args.until:
+        for u in args.until:
+            if u.strip():
+                filters.append('if {}: {}'.format(u.strip(), stop))
+    skip = "_stats.filtered += 1; continue" if is_filter_counted(args) else "continue"
     if args.filters:
         for f in args.filters:
             if not f.strip():
                 continue
-            filters.append('if not ({}): continue'.format(f.strip()))
+            filters.append('if not ({}): {}'.format(f.strip(), skip))
     return "\n".join(indent(c, level=level) for c in filters)
 
 
-def gen_loop_head_rec_csv(args):
+def gen_loop_head_rec_csv(args, level=1):
     loop_head_codes = ["# LOOP HEAD"]
-    if args.convert:
+    if args.convert and args.infer_types:
+        loop_head_codes.append("rec = _convert_rec(rec)")
+    elif args.convert:
         loop_head_codes.append("rec = [_convert(v) for v in rec]")
     if args.field_type:
         # ex) if len(rec) > 16 and rec[16]: rec[16] = int(rec[16])
         for f, t in args.field_type.items():
+            index = field_type_index(args, f)
             loop_head_codes.append(
                 "if len(rec) > {0} and rec[{0}]: rec[{0}] = {1}".format(
-                    f - 1, FIELD_TYPE_TMPL[t].format(f"rec[{f-1}]"))
+                    index, FIELD_TYPE_TMPL[t].format(f"rec[{index}]"))
             )
-    if args.field_length is not None:
-        if args.field_length == 0:
-            # define field variables dinamically
-            loop_head_codes.append(r"_locals.update({f'f{j+1}': rec[j] for j in range(len(rec))})")
-        else:
-            # ex) f1, f2, f3, f4 = r[:4]
-            loop_head_codes.append("{} = {}".format(
-                ", ".join(f"f{i+1}" for i in range(args.field_length)),
-                f"r[:{args.field_length}]",
-            ))
-    if args.header:
-        loop_head_codes.append("dic = dict(zip(header, rec))")
-        loop_head_codes.append("d = dic # ABBREV")
-
+    loop_head_codes.extend(gen_bind_fields(args))
     loop_head_codes.extend(extend_codes(args.loop_heads))
-    return "\n".join(indent(c) for c in loop_head_codes)
+    return "\n".join(indent(c, level) for c in loop_head_codes)
+
+
+def get_type_names(args):
+    return [f for f in args.field_type if isinstance(f, str)]
+
+
+def field_type_index(args, f):
+    # The index of a --type column, given by number or by header name.
+    if isinstance(f, str):
+        return f"_t{get_type_names(args).index(f)}"
+    return str(f - 1)
+
+
+def gen_header_indexes(args):
+    # The indexes of the named columns are looked up once the header is read.
+    if not args.header_keys and not get_type_names(args):
+        return []
+
+    def assign(prefix, keys, strict=False):
+        names = ", ".join(f"{prefix}{n}" for n in range(len(keys))) + ("," if len(keys) == 1 else "")
+        return f"{names} = _header_indexes(header, {tuple(keys)!r}{', strict=True' if strict else ''})"
+
+    codes = [HEADER_INDEX_FUNC, ""]
+    if args.header_keys:
+        codes.append(assign("_h", args.header_keys))
+    if get_type_names(args):
+        codes.append(assign("_t", get_type_names(args), strict=True))
+    return codes
+
+
+def gen_bind_fields(args):
+    codes = []
+    if args.field_length:
+        # ex) f1, f2, f3, f4 = r[:4]
+        codes.append("{} = {}".format(
+            ", ".join(f"f{i+1}" for i in range(args.field_length)),
+            f"r[:{args.field_length}]",
+        ))
+    elif args.field_numbers:
+        # Only the field variables used in the code are defined.
+        # ex) f2, f5 = _fields(rec) if len(rec) >= 5 else _fields([*rec, *_pad])
+        n = args.field_numbers[-1]
+        codes.append("{} = _fields(rec) if len(rec) >= {} else _fields([*rec, *_pad])".format(
+            ", ".join(f"f{f}" for f in args.field_numbers), n,
+        ))
+    if args.header and args.header_keys is None:
+        codes.append("dic = dict(zip(header, rec))")
+        codes.append("d = dic # ABBREV")
+    return codes
+
+
+def is_batch(args):
+    return "batch" in args and args.batch is not None
+
+
+def gen_batch(args, loop_start, wrapper, **params):
+    # The code runs once per batch of records, with rec, fN and dic bound to
+    # whole columns. Filters are evaluated as masks selecting the rows.
+    names = sorted(get_stored_names(args) - {"i", "_rows"})
+    loop_head = ["# LOOP HEAD", *gen_bind_fields(args), *extend_codes(args.loop_heads)]
+    loop_filter = ["# LOOP FILTER"]
+    filters = [f.strip() for f in args.filters or [] if f.strip()]
+    if filters:
+        loop_filter.append(f"_mask = {filters[0]}")
+        loop_filter.extend(f"_mask = _and(_mask, {f})" for f in filters[1:])
+        loop_filter.append("rec = r = [_select(c, _mask) for c in rec]")
+        loop_filter.extend(gen_bind_fields(args))
+    kinds = "{" + ", ".join(f"{field_type_index(args, f)}: {t!r}" for f, t in args.field_type.items()) + "}"
+    return TEMPLATE_BATCH.format(
+        names="\n    global " + ", ".join(names) if names else "",
+        kinds=kinds,
+        default_kind="c" if args.convert else "",
+        loop_start="\n".join(indent(c) for c in loop_start),
+        loop_head="\n".join(indent(c) for c in loop_head),
+        loop_filter="\n".join(indent(c) for c in loop_filter),
+        main=gen_main(args, "rec", wrapper),
+        size=args.batch,
+        **params,
+    )
+
+
+def gen_parallel(args, names, worker_head, loop_start, source, **params):
+    # Every name the loop body may assign is declared global in the worker
+    # so that the body behaves the same as it does at module level.
+    names = sorted({"i"} | set(names) | get_stored_names(args))
+    worker_head = list(worker_head)
+    if "reader" in args and args.reader == "mmap":
+        encoding = repr(args.encoding) if args.encoding else "sys.stdin.encoding"
+        params["chunk"] = "_mmap_range(_chunk)"
+        params["tasks"] = "_mmap_tasks(sys.stdin.buffer, {}, {}, {!r}, {}, {})".format(
+            args.block_size, encoding, args.errors or "strict", args.chunk_size,
+            check_record_number_in_code(args))
+    if args.output_buffer:
+        names.append("_writeln")
+        worker_head.append("_writeln = partial(print, file=sys.stdout)")
+    worker_result, merge = "None", ""
+    if args.counter:
+        worker_head.append("counter.clear()")
+        worker_result, merge = "counter", "counter.update(_result)"
+    elif is_group_by(args):
+        names.append("_acc")
+        worker_head.append("groups.clear()")
+        worker_result, merge = "groups", "_merge_groups(groups, _result)"
+    return TEMPLATE_PARALLEL.format(
+        names=", ".join(names),
+        worker_head="".join("\n" + indent(c) for c in worker_head),
+        loop_start="\n".join(indent(c, 2) for c in loop_start),
+        worker_result=worker_result,
+        processes=args.parallel or None,
+        imap="imap_unordered" if args.unordered else "imap",
+        merge=indent(merge, 2) if merge else "",
+        **{"chunk": "_chunk", "tasks": f"_chunks({source}, {args.chunk_size})", **params},
+    )
 
 
 def line_handler(args):
 
-    def gen_loop_head():
+    def gen_loop_head(level=1):
         loop_head_codes = ["# LOOP HEAD"]
         if args.convert:
             loop_head_codes.append("l = line = _convert(line)")
         if args.json:
-            loop_head_codes.append('dic = json.loads(line)')
+            loop_head_codes.append(gen_json_loads(args, "line"))
             loop_head_codes.append('d = dic  #ABBREV')
         loop_head_codes.extend(extend_codes(args.loop_heads))
-        return "\n".join(indent(c) for c in loop_head_codes)
+        return "\n".join(indent(c, level) for c in loop_head_codes)
 
     wrapper = r"view({})" if args.view else r"_print({})"
+    if args.parallel is not None:
+        if args.view:
+            wrapper = r"view({}, recnum=i)"
+        code = gen_parallel(
+            args,
+            names=("line", "l", "dic", "d"),
+            worker_head=[],
+            loop_start=[r'line = line.rstrip("\r\n")', "l = line  # ABBREV"],
+            imp=gen_import(args),
+            io=gen_io(args),
+            prelude="",
+            prepre="",
+            pre=gen_pre(args),
+            var="line",
+            loop_head=gen_loop_head(2),
+            loop_filter=gen_loop_filter(args, 2),
+            main=gen_main(args, "line", wrapper, level=2),
+            source=input_source(args),
+            post=gen_post(args),
+        )
+        exec_code(code, args)
+        return
     code = TEMPLATE_LINE.format(
         imp=gen_import(args),
+        io=gen_io(args),
+        source=input_source(args),
         pre=gen_pre(args),
         loop_head=gen_loop_head(),
         loop_filter=gen_loop_filter(args),
@@ -627,28 +2625,90 @@ def line_handler(args):
     exec_code(code, args)
 
 
+def gen_fields(args):
+    if args.field_length or not args.field_numbers:
+        return ""
+    indexes = ", ".join(str(f - 1) for f in args.field_numbers)
+    return "\n".join([
+        f"_fields = itemgetter({indexes})",
+        f"_pad = [None] * {args.field_numbers[-1]}",
+    ])
+
+
 def rec_handler(args):
+    source = input_source(args)
     is_regex_delimiter = args.delimiter != r'\t' and len(args.delimiter) > 1
+    # When only field variables are used, the line is split just up to the
+    # last one of them. The rest of the line is left in the last item.
+    maxsplit = ""
+    split_header = []
+    if not args.field_length and not args.rec_is_needed:
+        if args.header_keys:
+            maxsplit = ", _maxsplit"
+            last = args.field_numbers[-1] if args.field_numbers else 0
+            split_header = [f"_maxsplit = max([{last}, *(n + 1 for n in ({', '.join(f'_h{n}' for n in range(len(args.header_keys)))},) if isinstance(n, int))])"]
+        elif args.field_numbers:
+            maxsplit = f", {args.field_numbers[-1]}"
     if args.regex is not None:
         re_compile = rf"pattern = re.compile(r'{args.regex}')"
-        parse_header = r"header = pattern.findall(next(sys.stdin).rstrip('\r\n'))" if args.header else ""
+        parse_header = rf"header = pattern.findall(next({source}).rstrip('\r\n'))" if args.header else ""
         parse_line = r"rec = pattern.findall(line)"
     elif is_regex_delimiter:
         re_compile = rf"pattern = re.compile(r'{args.delimiter}')"
-        parse_header = r"header = pattern.split(next(sys.stdin).rstrip('\r\n'))" if args.header else ""
-        parse_line = r"rec = pattern.split(line)"
+        parse_header = rf"header = pattern.split(next({source}).rstrip('\r\n'))" if args.header else ""
+        parse_line = rf"rec = pattern.split(line{maxsplit})"
     else:
         re_compile = ""
-        parse_header = rf"header = next(sys.stdin).rstrip('\r\n').split('{args.delimiter}')" if args.header else ""
-        parse_line = rf"rec = line.split('{args.delimiter}')"
+        parse_header = rf"header = next({source}).rstrip('\r\n').split('{args.delimiter}')" if args.header else ""
+        parse_line = rf"rec = line.split('{args.delimiter}'{maxsplit})"
 
-    locals = "_locals = locals()" if args.field_length is not None and args.field_length == 0 else ""
+    fields = gen_fields(args)
     wrapper = r"_print({})"
     if args.view:
         wrapper = r"view({}, headers=header)" if args.header else r"view({})"
+    if args.parallel is not None:
+        if args.view:
+            wrapper = r"view({}, recnum=i, headers=header)" if args.header else r"view({}, recnum=i)"
+        code = gen_parallel(
+            args,
+            names=("line", "rec", "r", "dic", "d"),
+            worker_head=[],
+            loop_start=[r'line = line.rstrip("\r\n")', parse_line, "r = rec  # ABBREV"],
+            imp=gen_import(args),
+            io=gen_io(args),
+            prelude="",
+            prepre='\n'.join([*extend_codes([re_compile, parse_header, fields]), *gen_header_indexes(args), *split_header]),
+            pre=gen_pre(args),
+            var="line",
+            loop_head=gen_loop_head_rec_csv(args, 2),
+            loop_filter=gen_loop_filter(args, 2),
+            main=gen_main(args, "rec", wrapper, level=2),
+            source=source,
+            post=gen_post(args),
+        )
+        exec_code(code, args)
+        return
+    if is_batch(args):
+        code = gen_batch(
+            args,
+            loop_start=[r'line = line.rstrip("\r\n")', parse_line],
+            wrapper=r"_batch_out(_print, {})",
+            imp=gen_import(args),
+            io=gen_io(args),
+            prelude="",
+            prepre='\n'.join([*extend_codes([re_compile, parse_header, fields]), *gen_header_indexes(args), *split_header]),
+            pre=gen_pre(args),
+            var="line",
+            source=source,
+            post=gen_post(args),
+        )
+        exec_code(code, args)
+        return
     code = TEMPLATE_REC.format(
         imp=gen_import(args),
-        prepre='\n'.join(extend_codes([re_compile, parse_header, locals])),
+        io=gen_io(args),
+        source=source,
+        prepre='\n'.join([*extend_codes([re_compile, parse_header, fields]), *gen_header_indexes(args), *split_header]),
         pre=gen_pre(args),
         parse_line=parse_line,
         loop_head=gen_loop_head_rec_csv(args),
@@ -669,16 +2729,74 @@ def csv_handler(args):
     reader_opts = ", ".join(f'{k}={v}' for k, v in csv_reader_opts)
     writer_opts = ", ".join(f'{k}={v}' for k, v in csv_writer_opts)
     parse_header = "header = next(reader)" if args.header else ""
+    # The -O options may change the quoting, so only the csv module
+    # handles them.
+    fast = args.csv_engine == "auto" and not args.csv_opts
+    if fast:
+        prelude = CSV_FAST_PRELUDE.format(
+            delimiter=f"'{args.delimiter}'", output_delimiter=f"'{output_delimiter}'",
+            reader_opts=reader_opts, writer_opts=writer_opts)
+    else:
+        prelude = TEMPLATE_CSV_PRELUDE.format(reader_opts=reader_opts, writer_opts=writer_opts)
 
-    locals = "_locals = locals()" if args.field_length is not None and args.field_length == 0 else ""
+    fields = gen_fields(args)
     wrapper = r"_write({}, writer=writer)"
     if args.view:
         wrapper = r"view({}, headers=header)" if args.header else r"view({})"
+    if args.parallel is not None:
+        if args.view:
+            wrapper = r"view({}, recnum=i, headers=header)" if args.header else r"view({}, recnum=i)"
+        # The parent parses the records so that quoted fields spanning
+        # multiple lines are never split across chunks.
+        code = gen_parallel(
+            args,
+            names=("rec", "r", "dic", "d", "writer", "_w"),
+            worker_head=[f"writer = csv.writer(sys.stdout, {writer_opts})", "_w = writer.writerow  # ABBREV"],
+            loop_start=["r = rec  # ABBREV"],
+            imp=gen_import(args),
+            io=gen_io(args),
+            prelude=prelude,
+            prepre='\n'.join([*extend_codes([parse_header, fields]), *gen_header_indexes(args)]),
+            pre=gen_pre(args),
+            var="rec",
+            loop_head=gen_loop_head_rec_csv(args, 2),
+            loop_filter=gen_loop_filter(args, 2),
+            main=gen_main(args, "rec", wrapper, level=2),
+            source="reader",
+            post=gen_post(args),
+        )
+        exec_code(code, args)
+        return
+    if is_batch(args):
+        code = gen_batch(
+            args,
+            loop_start=[],
+            wrapper=r"_batch_out(partial(_write, writer=writer), {})",
+            imp=gen_import(args),
+            io=gen_io(args),
+            prelude=prelude,
+            prepre='\n'.join([*extend_codes([parse_header, fields]), *gen_header_indexes(args)]),
+            pre=gen_pre(args),
+            var="rec",
+            source="reader",
+            post=gen_post(args),
+        )
+        exec_code(code, args)
+        return
+    if fast:
+        loop = "line in enumerate(sys.stdin, 1)"
+        parse_line = indent(
+            """rec = _csv_line(line) if '"' in line or len(line) < 3 else line.rstrip("\\r\\n").split('{}')""".format(
+                args.delimiter)) + "\n"
+    else:
+        loop, parse_line = "rec in enumerate(reader, 1)", ""
     code = TEMPLATE_CSV.format(
         imp=gen_import(args),
-        reader_opts=reader_opts,
-        writer_opts=writer_opts,
-        prepre='\n'.join(extend_codes([parse_header, locals])),
+        io=gen_io(args),
+        prelude=prelude,
+        loop=loop,
+        parse_line=parse_line,
+        prepre='\n'.join([*extend_codes([parse_header, fields]), *gen_header_indexes(args)]),
         pre=gen_pre(args),
         loop_head=gen_loop_head_rec_csv(args),
         loop_filter=gen_loop_filter(args),
@@ -695,13 +2813,30 @@ def text_handler(args):
         if args.convert:
             codes.append("text = _convert(text)")
         if args.json:
-            codes.append("dic = json.loads(text)")
+            codes.append(gen_json_loads(args, "text"))
             codes.append('d = dic  #ABBREV')
         return "\n".join(codes)
 
     wrapper = r"view({})" if args.view else r"_print({})"
+    if args.stream is not None:
+        path = [name for name in args.stream.split(".") if name]
+        if path[-1:] != ["*"]:
+            path.append("*")
+        code = TEMPLATE_TEXT_STREAM.format(
+            imp=gen_import(args),
+            io=gen_io(args),
+            pre=gen_pre(args) + "\n" + JSON_STREAM_FUNC,
+            path=path,
+            loop_head="\n".join(indent(c) for c in extend_codes(args.loop_heads, "LOOP HEAD")),
+            loop_filter=gen_loop_filter(args),
+            main=gen_main(args, "dic", wrapper),
+            post=gen_post(args),
+        )
+        exec_code(code, args)
+        return
     code = TEMPLATE_TEXT.format(
         imp=gen_import(args),
+        io=gen_io(args),
         pre=gen_pre(args),
         pre_main=gen_pre_main(),
         main=gen_main(args, "text", wrapper, level=0),
@@ -712,22 +2847,92 @@ def text_handler(args):
 
 def file_handler(args):
 
-    def gen_loop_head():
+    var = "line" if args.lines else "text"
+
+    def gen_loop_head(level=2):
         loop_head_codes = extend_codes(args.loop_heads, "LOOP HEAD")
         if args.convert:
-            loop_head_codes.append("text = _convert(text)")
+            loop_head_codes.append(f"{var} = _convert({var})")
         if args.json:
-            loop_head_codes.append("dic = json.loads(text)")
-        return "\n".join(indent(c, 2) for c in loop_head_codes)
+            loop_head_codes.append(gen_json_loads(args, var))
+        return "\n".join(indent(c, level) for c in loop_head_codes)
 
     wrapper = r"view({})" if args.view else r"_print({})"
+    open_opts = "".join(
+        f", {k}={v!r}" for k, v in (("encoding", args.encoding), ("errors", args.errors)) if v)
+    if args.decompress == "auto":
+        fmt = "_sniff(path)"
+    elif args.decompress:
+        fmt = repr(args.decompress)
+    else:
+        fmt = "_SUFFIXES.get(path.suffix)"
+    prelude = FILE_OPEN_FUNC.format(fmt=fmt, mode=args.mode, open_opts=open_opts)
+    source = input_source(args)
+    read_file = [r"path = Path(line.rstrip('\r\n'))", "with _open(path) as file:", "    text = file.read()"]
+    stop, stop_outer = "break", ""
+    if args.parallel is not None and args.pool == "process":
+        if args.view:
+            wrapper = r"view({}, recnum=i)"
+        code = gen_parallel(
+            args,
+            names=("line", "path", "file", "text", "dic"),
+            worker_head=[],
+            loop_start=read_file,
+            imp=gen_import(args),
+            io=gen_io(args),
+            prelude=prelude,
+            prepre="",
+            pre=gen_pre(args),
+            var="line",
+            loop_head=gen_loop_head(),
+            loop_filter=gen_loop_filter(args, 2),
+            main=gen_main(args, "text", wrapper, level=2),
+            source=source,
+            post=gen_post(args),
+        )
+        exec_code(code, args)
+        return
+    if args.lines or args.chunked:
+        # Each file is streamed, so that it is never read into memory at once.
+        # i is the number of the line (chunk) in the file and n is the
+        # number over all the files.
+        prelude += "\n\nn = 0"
+        if args.lines:
+            newline = r"b'\r\n'" if "b" in args.mode else r"'\r\n'"
+            read_file[2:] = ["    for i, line in enumerate(file, 1):", "        n += 1",
+                             f"        l = line = line.rstrip({newline})  # ABBREV"]
+        else:
+            sentinel = "b''" if "b" in args.mode else "''"
+            read_file[2:] = [f"    for i, text in enumerate(iter(partial(file.read, {args.chunked}), {sentinel}), 1):",
+                             "        n += 1"]
+        loop = f"line in {source}"
+        level = 3
+        loop_head = "\n".join([*(indent(c) for c in read_file), gen_loop_head(level)])
+        if args.head or args.until:
+            # break leaves only the loop over the lines of a file.
+            prelude += "\n_stop = False"
+            stop, stop_outer = "_stop = True; break", "\n" + indent("if _stop: break")
+    elif args.parallel is not None:
+        # The body runs in the main process while the next files are read.
+        prelude += "\n\n" + FILE_PREFETCH_FUNC
+        # -P 0 reads the files in as many threads as CPUs.
+        workers = args.parallel or "os.cpu_count() or 1"
+        loop = f"i, path, text in _prefetch({source}, {workers}, {not args.unordered})"
+        level = 1
+        loop_head = gen_loop_head(level)
+    else:
+        loop = f"i, line in enumerate({source}, 1)"
+        level = 2
+        loop_head = "\n".join([*(indent(c) for c in read_file), gen_loop_head(level)])
     code = TEMPLATE_FILE.format(
         imp=gen_import(args),
+        io=gen_io(args),
+        prelude=prelude,
         pre=gen_pre(args),
-        mode=args.mode,
-        loop_head=gen_loop_head(),
-        loop_filter=gen_loop_filter(args, 2),
-        main=gen_main(args, "text", wrapper, level=2),
+        loop=loop,
+        loop_head=loop_head,
+        loop_filter=gen_loop_filter(args, level, stop),
+        main=gen_main(args, var, wrapper, level=level, stop=stop) + stop_outer,
         post=gen_post(args),
     )
     exec_code(code, args)
@@ -762,7 +2967,7 @@ def custom_handler(args):
 
     wrapper = r"view({})" if args.view else wrapper
     params = {
-        "imp": gen_import(args),
+        "imp": gen_import(args) + gen_io(args),
         "pre": gen_pre(args),
         "loop_head": gen_loop_head(),
         "loop_filter": gen_loop_filter(args, code_indent),
@@ -779,16 +2984,168 @@ def custom_handler(args):
     exec_code(code, args)
 
 
+# (name, data, arguments)
+BENCH_CASES = [
+    ("line", "tsv", ["line", "len(line)"]),
+    ("line_json", "jsonl", ["line", "-j", 'dic["level"]']),
+    ("line_json_fj", "jsonl", ["line", "-j", "-Fj", 'dic["meta"]']),
+    ("rec", "tsv", ["rec", "f1, f3"]),
+    ("rec_length", "tsv", ["rec", "-l", "23", "f1, f3"]),
+    ("rec_convert", "tsv", ["rec", "-t", "rec[1] + rec[2]"]),
+    ("rec_convert_generic", "tsv", ["rec", "-t", "--infer-types", "0", "rec[1] + rec[2]"]),
+    ("rec_type", "tsv", ["rec", "--type", "2:i,3:f", "f2 + f3"]),
+    ("rec_header", "tsv_header", ["rec", "-H", 'dic["c2"], dic["c5"]']),
+    ("rec_counter", "tsv", ["rec", "-c", "f5"]),
+    ("rec_view", "tsv", ["rec", "-v", "-knever", "rec[:4]"]),
+    ("rec_fj", "tsv", ["rec", "-Fj", "rec[:4]"]),
+    ("csv", "csv", ["csv", "f1, f3"]),
+    ("csv_header", "csv", ["csv", "-H", 'dic["c2"], dic["c4"]']),
+    ("csv_plain", "csv_plain", ["csv", "rec"]),
+    ("csv_plain_header", "csv_plain", ["csv", "-H", 'dic["c2"], dic["c4"]']),
+    ("csv_plain_module", "csv_plain", ["csv", "--csv-engine", "csv", "rec"]),
+    ("text_json", "json", ["text", "-j", 'len(dic["items"])']),
+    ("file_gzip", "gzip_files", ["file", "path.name, len(text)"]),
+]
+
+# (name, reference, ratio): the case must take at most ratio times the time
+# of the reference case, which runs the same code without the optimization.
+BENCH_SPEEDUPS = [
+    ("rec_convert", "rec_convert_generic", 0.8),
+]
+
+
+def gen_bench_data(kind, path, records):
+    # The data is generated with a fixed seed so that the runs are comparable.
+    import gzip
+    import json
+    import random
+    rand = random.Random(0)
+    words = ["alpha", "beta", "gamma", "delta", "epsilon", "zeta", "eta", "theta"]
+
+    def row(i):
+        return [str(i), str(rand.randint(0, 10000)), f"{rand.random() * 100:.3f}",
+                rand.choice(words), rand.choice(words[:4])] + [
+                    rand.choice(words) + str(rand.randint(0, 99)) for _ in range(18)]
+
+    with open(path, "w") as f:
+        if kind in ("tsv", "tsv_header"):
+            if kind == "tsv_header":
+                f.write("\t".join(f"c{j + 1}" for j in range(23)) + "\n")
+            for i in range(records):
+                f.write("\t".join(row(i)) + "\n")
+        elif kind in ("csv", "csv_plain"):
+            import csv
+            writer = csv.writer(f)
+            writer.writerow([f"c{j + 1}" for j in range(8)])
+            for i in range(records):
+                r = row(i)[:8]
+                if kind == "csv":
+                    r[3] = f'{r[3]}, "{r[4]}"'  # quoted field with a comma and quotes
+                writer.writerow(r)
+        elif kind in ("jsonl", "json"):
+            items = ({"id": i, "level": rand.choice(["info", "warn", "error"]), "msg": " ".join(row(i)[3:9]),
+                      "meta": {"host": f"h{i % 16}", "took": rand.random()}} for i in range(records))
+            if kind == "jsonl":
+                f.writelines(json.dumps(item) + "\n" for item in items)
+            else:
+                json.dump({"items": list(items)}, f)
+        elif kind == "gzip_files":
+            # Many small files with 100 records each.
+            directory = path + ".d"
+            makedirs(directory, exist_ok=True)
+            for n in range(max(records // 100, 1)):
+                file_path = join(directory, f"{n}.tsv.gz")
+                with gzip.open(file_path, "wt") as g:
+                    g.writelines("\t".join(row(n * 100 + i)) + "\n" for i in range(100))
+                f.write(file_path + "\n")
+
+
+def bench_handler(args):
+    import json
+    import re
+    import subprocess
+    import tempfile
+    from time import perf_counter
+    cases = [case for case in BENCH_CASES if args.only is None or re.search(args.only, case[0])]
+    results = {}
+    with tempfile.TemporaryDirectory() as directory:
+        data = {}
+        for name, kind, argv in cases:
+            if kind not in data:
+                data[kind] = join(directory, kind)
+                gen_bench_data(kind, data[kind], args.records)
+            times = []
+            # The first run is not measured; it fills the compiled code cache.
+            for _ in range(args.repeat + 1):
+                with open(data[kind]) as stdin:
+                    start = perf_counter()
+                    subprocess.run([sys.executable, __file__, *argv], stdin=stdin,
+                                   stdout=subprocess.DEVNULL, check=True)
+                    times.append(perf_counter() - start)
+            results[name] = round(min(times[1:]), 4)
+            print(f"{name:<16}{results[name]:>10.4f}s", file=sys.stderr)
+
+    report = {
+        "pypipe": __version__,
+        "python": sys.version.split()[0],
+        "records": args.records,
+        "repeat": args.repeat,
+        "results": results,
+    }
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+            f.write("\n")
+    else:
+        print(json.dumps(report, indent=2))
+
+    slow = []
+    for name, reference, ratio in BENCH_SPEEDUPS:
+        if name in results and reference in results:
+            current = results[name] / results[reference] if results[reference] else float("inf")
+            mark = "  TOO SLOW" if current > ratio else ""
+            print(f"{name} / {reference}: {current:.2f} (<= {ratio}){mark}", file=sys.stderr)
+            if mark:
+                slow.append(name)
+    if slow:
+        sys.exit(f"not faster than the reference cases: {', '.join(slow)}")
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)["results"]
+        regressions = []
+        print(f"{'CASE':<16}{'BASELINE':>10}{'CURRENT':>10}{'RATIO':>8}", file=sys.stderr)
+        for name, seconds in results.items():
+            if name not in baseline:
+                continue
+            ratio = seconds / baseline[name] if baseline[name] else float("inf")
+            mark = "  REGRESSION" if ratio > args.threshold else ""
+            print(f"{name:<16}{baseline[name]:>10.4f}{seconds:>10.4f}{ratio:>8.2f}{mark}", file=sys.stderr)
+            if mark:
+                regressions.append(name)
+        if regressions:
+            sys.exit(f"regressions (> x{args.threshold}): {', '.join(regressions)}")
+
+
 def main(argv=sys.argv[1:]):
     def key_value(s):
         kv = s.split("=", 1)
         return kv[0], kv[1]
 
+    def byte_size(s):
+        import re
+        units = {"": 1, "k": 1024, "m": 1024 ** 2, "g": 1024 ** 3}
+        m = re.match(r'^(\d+)([kmg]?)(?:i?b)?$', s.strip().lower())
+        if not m:
+            raise argparse.ArgumentTypeError(f"invalid size: {s}")
+        return int(m.group(1)) * units[m.group(2)]
+
     def field_type(s):
         ret = {}
         for ft in s.split(","):
             f, t = ft.split(":", 1)
-            ret[int(f)] = t
+            # A column is given by number or, with -H, by header name.
+            ret[int(f) if f.isdigit() else f] = t
         return ret
 
     parser = argparse.ArgumentParser(
@@ -801,255 +3158,611 @@ def main(argv=sys.argv[1:]):
     )
 
     ## COMMON OPTIONS
-    common_parser = argparse.ArgumentParser(add_help=False)
-    common_parser.add_argument(
-        "-v", '--view',
-        action="store_true",
-    )
-    common_parser.add_argument(
-        "-k", '--color',
-        choices=['always', 'auto', 'never'],
-        default='auto',
-    )
-    common_parser.add_argument(
-        "-p", '--print',
-        action="store_true",
-        help="Only prints the generated code."
-    )
-    common_parser.add_argument(
-        "-o", '--output',
-        help="Output file"
-    )
-    common_parser.add_argument(
-        "-q", '--no-comments',
-        dest="no_comments",
-        action="store_true",
-    )
-    common_parser.add_argument(
-        "-r", '--no-abbrevs',
-        dest="no_abbrevs",
-        action="store_true",
-    )
-    common_parser.add_argument(
-        "-n", '--no-wrapping',
-        dest="no_wrapping",
-        action="store_true"
-    )
-    common_parser.add_argument(
-        "-i", '--import',
-        dest="import_codes",
-        action="append",
-    )
-    common_parser.add_argument(
-        "-b", '--pre',
-        dest="pre_codes",
-        action="append",
-    )
-    common_parser.add_argument(
-        "-a", '--post',
-        dest="post_codes",
-        action="append",
-    )
-    common_parser.add_argument(
-        '-c', '--counter',
-        action="store_true"
-    )
-    common_parser.add_argument(
-        '-D', '--output-delimiter',
-        dest="output_delimiter",
-    )
-    common_parser.add_argument(
-        '-L', '--linebreak',
-        action='store_const',
-        const=r'\n',
-        dest="output_delimiter",
-    )
-    common_parser.add_argument(
-        '-F', '--output-format',
-        choices=FORMAT_PRINT_FUNC.keys(),
-        default='default',
-        dest="output_format",
-    )
-    common_parser.add_argument(
-        '-t', '--convert',
-        action="store_true",
-    )
-    common_parser.add_argument(
-        '--paging',
-        dest="paging",
-        action="store_const",
-        const=True,
-    )
-    common_parser.add_argument(
-        '--no-paging',
-        dest="paging",
-        action="store_const",
-        const=False,
-    )
+    def add_common_options(parser):
+        parser.add_argument(
+            "-v", '--view',
+            action="store_true",
+        )
+        parser.add_argument(
+            '--view-table',
+            dest="view_table",
+            action="store_true",
+            help="View mode that renders the records as a table. The widths of the columns are taken "
+                 "from the first --view-sample records, and the rest are streamed. Implies -v."
+        )
+        parser.add_argument(
+            '--view-sample',
+            dest="view_sample",
+            type=int,
+            default=100,
+            metavar="N",
+            help="Number of records sampled by --view-table (default: 100)."
+        )
+        parser.add_argument(
+            "-k", '--color',
+            choices=['always', 'auto', 'never'],
+            default='auto',
+        )
+        parser.add_argument(
+            "-p", '--print',
+            action="store_true",
+            help="Only prints the generated code."
+        )
+        parser.add_argument(
+            "-o", '--output',
+            help="Output file"
+        )
+        parser.add_argument(
+            "-q", '--no-comments',
+            dest="no_comments",
+            action="store_true",
+        )
+        parser.add_argument(
+            "-r", '--no-abbrevs',
+            dest="no_abbrevs",
+            action="store_true",
+        )
+        parser.add_argument(
+            "-n", '--no-wrapping',
+            dest="no_wrapping",
+            action="store_true"
+        )
+        parser.add_argument(
+            "-i", '--import',
+            dest="import_codes",
+            action="append",
+        )
+        parser.add_argument(
+            "-b", '--pre',
+            dest="pre_codes",
+            action="append",
+        )
+        parser.add_argument(
+            "-a", '--post',
+            dest="post_codes",
+            action="append",
+        )
+        parser.add_argument(
+            '-c', '--counter',
+            action="store_true"
+        )
+        parser.add_argument(
+            '--approx',
+            choices=['heavy', 'distinct'],
+            help="Approximate -c, --counter in bounded memory. "
+                 "heavy: top counts (Space-Saving), distinct: number of distinct keys (HyperLogLog)."
+        )
+        parser.add_argument(
+            '--capacity',
+            type=int,
+            default=10000,
+            help="Number of keys kept by --approx heavy. Counts are overestimated by at most N/capacity."
+        )
+        parser.add_argument(
+            '--precision',
+            type=int,
+            choices=range(4, 19),
+            default=14,
+            metavar="{4..18}",
+            help="--approx distinct uses 2**precision registers (standard error: 1.04/sqrt(2**precision))."
+        )
+        parser.add_argument(
+            '--top',
+            type=int,
+            metavar="N",
+            help="Output only the top N results of -c or --group-by."
+        )
+        parser.add_argument(
+            '-D', '--output-delimiter',
+            dest="output_delimiter",
+        )
+        parser.add_argument(
+            '-L', '--linebreak',
+            action='store_const',
+            const=r'\n',
+            dest="output_delimiter",
+        )
+        parser.add_argument(
+            '-F', '--output-format',
+            choices=FORMAT_PRINT_FUNC.keys(),
+            default='default',
+            dest="output_format",
+        )
+        parser.add_argument(
+            '--json-backend',
+            dest="json_backend",
+            choices=['stdlib', 'orjson', 'ujson', 'simdjson', 'auto'],
+            default='stdlib',
+            help="JSON library used by -j, --json and -F json. auto: orjson, ujson or stdlib, "
+                 "whichever is installed first. With simdjson, -j decodes only the keys read as dic[\"KEY\"]."
+        )
+        parser.add_argument(
+            '--profile',
+            choices=['cprofile', 'sample'],
+            help="Profile the generated code and print a report to stderr at exit. "
+                 "sample prints the time of each section (# LOOP HEAD, # MAIN, ...) and the hot lines; "
+                 "cprofile prints the cProfile statistics instead."
+        )
+        parser.add_argument(
+            '--profile-output',
+            dest="profile_output",
+            metavar="FILE",
+            help="Write the pstats file of --profile cprofile to FILE."
+        )
+        parser.add_argument(
+            '--stats',
+            action="store_true",
+            help="Print the number of input, filtered and output records, the bytes read and "
+                 "written, and the wall and CPU time to stderr at exit."
+        )
+        parser.add_argument(
+            '--stats-format',
+            dest="stats_format",
+            choices=['text', 'json'],
+            help="Format of --stats. json: one JSON object per line. Implies --stats."
+        )
+        parser.add_argument(
+            '--stats-interval',
+            dest="stats_interval",
+            type=float,
+            metavar="SECONDS",
+            help="Also print the progress of --stats every SECONDS seconds. Implies --stats."
+        )
+        parser.add_argument(
+            '-t', '--convert',
+            action="store_true",
+        )
+        parser.add_argument(
+            '--output-buffer',
+            dest="output_buffer",
+            type=byte_size,
+            help="Buffer the output and write it in chunks of this size. ex) 64K, 1M"
+        )
+        parser.add_argument(
+            '--no-cache',
+            dest="no_cache",
+            action="store_true",
+            help="Do not use the cache of compiled code."
+        )
+        parser.add_argument(
+            '--paging',
+            dest="paging",
+            action="store_const",
+            const=True,
+        )
+        parser.add_argument(
+            '--no-paging',
+            dest="paging",
+            action="store_const",
+            const=False,
+        )
 
     ## LOOP OPTIONS
-    loop_parser = argparse.ArgumentParser(add_help=False)
-    loop_parser.add_argument(
-        "-e", "--loop-head",
-        dest="loop_heads",
-        default=[],
-        action="append",
-    )
-    loop_parser.add_argument(
-        "-f", "--filter",
-        dest="filters",
-        action="append",
-    )
+    def add_loop_options(parser):
+        parser.add_argument(
+            "-e", "--loop-head",
+            dest="loop_heads",
+            default=[],
+            action="append",
+        )
+        parser.add_argument(
+            "-f", "--filter",
+            dest="filters",
+            action="append",
+        )
+        parser.add_argument(
+            "--head",
+            metavar="N",
+            type=int,
+            help="stop after N records have passed the filters. The code in --post still runs.",
+        )
+        parser.add_argument(
+            "--until",
+            metavar="EXPR",
+            action="append",
+            help="stop before the first record for which EXPR is true.",
+        )
+
+    ## INPUT OPTIONS
+    def add_input_options(parser):
+        parser.add_argument(
+            "--reader",
+            choices=["text", "block", "mmap"],
+            default="text",
+            help="text: iterate over sys.stdin, block: read sys.stdin.buffer in large blocks, "
+                 "mmap: map stdin into memory if it is a regular file (otherwise block)."
+        )
+        parser.add_argument(
+            "--block-size",
+            dest="block_size",
+            type=byte_size,
+            default="1M",
+            help="Block size of the block reader. ex) 65536, 512K, 8M"
+        )
+        parser.add_argument(
+            "--encoding",
+        )
+        parser.add_argument(
+            "--errors",
+            help="Error handler for decoding. ex) strict, replace, ignore"
+        )
+
+    ## DECOMPRESSION OPTIONS
+    def add_decompress_options(parser):
+        parser.add_argument(
+            "-z",
+            dest="decompress",
+            action="store_const",
+            const="auto",
+            help="Same as --decompress auto."
+        )
+        parser.add_argument(
+            "--decompress",
+            dest="decompress",
+            choices=["auto", "gzip", "bz2", "xz", "zstd"],
+            help="Decompress the standard input (and the files of `file`) in the process. "
+                 "auto: detect the format from the magic bytes."
+        )
+
+    ## PARALLEL OPTIONS
+    def add_parallel_options(parser):
+        parser.add_argument(
+            "-P", "--parallel",
+            dest="parallel",
+            type=int,
+            metavar="N",
+            help="Run the loop in N worker processes (0: number of CPUs)."
+        )
+        parser.add_argument(
+            "--chunk-size",
+            dest="chunk_size",
+            type=int,
+            help="Number of records sent to a worker at once (default: 10000, file: 1)."
+        )
+        parser.add_argument(
+            "--unordered",
+            action="store_true",
+            help="Output chunks in completion order."
+        )
 
     ## REC AND CSV OPTIONS
-    rec_csv_parser = argparse.ArgumentParser(add_help=False)
-    rec_csv_parser.add_argument(
-        '-l', '--field-length',
-        dest="field_length",
-        type=int,
-    )
-    rec_csv_parser.add_argument(
-        '--type', '--field-type',
-        dest="field_type",
-        type=field_type,
-        default={},
-        help="ex) 1:i,3:j,5:b"
-    )
-    rec_csv_parser.add_argument(
-        '-H', '--header',
-        action="store_true",
-    )
+    def add_rec_csv_options(parser):
+        parser.add_argument(
+            '-l', '--field-length',
+            dest="field_length",
+            type=int,
+        )
+        parser.add_argument(
+            '--type', '--field-type',
+            dest="field_type",
+            type=field_type,
+            default={},
+            help="ex) 1:i,3:j,5:b or, with -H, Weight:i,Age:i"
+        )
+        parser.add_argument(
+            '--infer-types',
+            dest="infer_types",
+            type=int,
+            default=100,
+            metavar="N",
+            help="With -t, --convert, infer the type of each column from the first N records "
+                 "and convert the rest directly (0: convert every value with the generic converter)."
+        )
+        parser.add_argument(
+            '--batch',
+            type=int,
+            metavar="N",
+            help="Run the code once per N records with rec, fN and dic bound to whole columns "
+                 "(NumPy arrays if NumPy is installed, otherwise lists with elementwise operators)."
+        )
+        parser.add_argument(
+            '-H', '--header',
+            action="store_true",
+        )
+        parser.add_argument(
+            '-g', '--group-by',
+            dest="group_by",
+            metavar="KEYEXPR",
+            help="Aggregate the records by the value of KEYEXPR."
+        )
+        parser.add_argument(
+            '--agg',
+            default="count()",
+            help="Aggregations for --group-by. ex) 'sum(f3),max(f4),mean(f5),count()'"
+        )
 
     # SUB COMMANDS
-    subparsers = parser.add_subparsers(
-        title="subcommands",
-        help="show subcommands help: %(prog)s subcommand -h"
-    )
-
     ## LINE
-    line_parser = subparsers.add_parser(
-        "line", aliases=['l'], parents=[common_parser, loop_parser])
-    line_parser.add_argument(
-        '-j', '--json',
-        action="store_true"
-    )
-    line_parser.add_argument("codes", nargs='*')
-    line_parser.set_defaults(handler=line_handler, command="line")
+    def add_line_options(parser):
+        parser.add_argument(
+            '-j', '--json',
+            action="store_true"
+        )
+        parser.add_argument("codes", nargs='*')
+        parser.set_defaults(handler=line_handler, command="line")
 
     ## REC
-    rec_parser = subparsers.add_parser(
-        "rec", aliases=['r', 'record'], parents=[common_parser, loop_parser, rec_csv_parser])
-    rec_parser.add_argument("codes", nargs='*')
-    rec_parser.add_argument(
-        '-d', '--delimiter',
-        default=r'\t'
-    )
-    rec_parser.add_argument(
-        '-m', '--regex-match',
-        dest="regex",
-    )
-    rec_parser.add_argument(
-        '-C', '--csv',
-        action='store_const',
-        dest="delimiter",
-        const=',',
-    )
-    rec_parser.add_argument(
-        '-S', '--spaces',
-        action='store_const',
-        dest="delimiter",
-        const=r'\s+',
-    )
-    rec_parser.set_defaults(handler=rec_handler, command="rec")
+    def add_rec_options(parser):
+        parser.add_argument("codes", nargs='*')
+        parser.add_argument(
+            '-d', '--delimiter',
+            default=r'\t'
+        )
+        parser.add_argument(
+            '-m', '--regex-match',
+            dest="regex",
+        )
+        parser.add_argument(
+            '-C', '--csv',
+            action='store_const',
+            dest="delimiter",
+            const=',',
+        )
+        parser.add_argument(
+            '-S', '--spaces',
+            action='store_const',
+            dest="delimiter",
+            const=r'\s+',
+        )
+        parser.set_defaults(handler=rec_handler, command="rec")
 
     ## CSV
-    csv_parser = subparsers.add_parser(
-        "csv", parents=[common_parser, loop_parser, rec_csv_parser])
-    csv_parser.add_argument("codes", nargs='*')
-    csv_parser.add_argument(
-        '-d', '--delimiter',
-        default=','
-    )
-    csv_parser.add_argument(
-        '-O', '--csv-opt',
-        dest="csv_opts",
-        type=key_value,
-        default=[],
-        action="append",
-    )
-    csv_parser.add_argument(
-        '-T', '--tsv',
-        action='store_const',
-        dest="delimiter",
-        const=r'\t',
-    )
-    csv_parser.set_defaults(handler=csv_handler, command="csv")
+    def add_csv_options(parser):
+        parser.add_argument("codes", nargs='*')
+        parser.add_argument(
+            '-d', '--delimiter',
+            default=','
+        )
+        parser.add_argument(
+            '-O', '--csv-opt',
+            dest="csv_opts",
+            type=key_value,
+            default=[],
+            action="append",
+        )
+        parser.add_argument(
+            '--csv-engine',
+            dest="csv_engine",
+            choices=["auto", "csv"],
+            default="auto",
+            help="auto: split the lines without quotes with str.split and join the output fields "
+                 "that need no quoting, and use the csv module for the others. csv: always use the csv module. "
+                 "With -O, the csv module is always used."
+        )
+        parser.add_argument(
+            '-T', '--tsv',
+            action='store_const',
+            dest="delimiter",
+            const=r'\t',
+        )
+        parser.set_defaults(handler=csv_handler, command="csv")
 
     ## TEXT
-    text_parser = subparsers.add_parser(
-        "text", aliases=['t'], parents=[common_parser])
-    text_parser.add_argument("codes", nargs='*')
-    text_parser.add_argument(
-        '-j', '--json',
-        action="store_true"
-    )
-    text_parser.set_defaults(handler=text_handler, command="text")
+    def add_text_options(parser):
+        parser.add_argument("codes", nargs='*')
+        parser.add_argument(
+            '-j', '--json',
+            action="store_true"
+        )
+        parser.add_argument(
+            '--stream',
+            metavar="PATH",
+            help="Parse the JSON input incrementally and run the code for each element of the array "
+                 "(or each value of the object) at PATH as dic. ex) '*', 'items.*', 'data.rows'"
+        )
+        parser.set_defaults(handler=text_handler, command="text")
 
     ## FILE
-    file_parser = subparsers.add_parser(
-        "file", aliases=['f'], parents=[common_parser, loop_parser])
-    file_parser.add_argument("codes", nargs='*')
-    file_parser.add_argument(
-        "-m", "--mode",
-        default='rt',
-    )
-    file_parser.add_argument(
-        '-j', '--json',
-        action="store_true"
-    )
-    file_parser.set_defaults(handler=file_handler, command="file")
-
-   ## CUSTOM
-    custom_parser = subparsers.add_parser(
-        "custom", aliases=['c'], parents=[common_parser, loop_parser])
-    custom_parser.add_argument(
-        '-O', '--opt',
-        action="append",
-        dest="opts",
-        default=[],
-        type=key_value,
-    )
-    custom_parser.add_argument(
-        "-N", "--name",
-        required=True,
-    )
-    custom_parser.add_argument("codes", nargs='*')
-    custom_parser.set_defaults(handler=custom_handler, command="custom")
-
-    expected_1st_args = (
-        "line", "l", "rec", "r", "csv", "text", "t", "file", "f", "custom", "c",
+    def add_file_options(parser):
+        parser.add_argument("codes", nargs='*')
+        parser.add_argument(
+            "-m", "--mode",
+            default='rt',
+        )
+        parser.add_argument(
+            '-j', '--json',
+            action="store_true"
+        )
+        file_stream_group = parser.add_mutually_exclusive_group()
+        file_stream_group.add_argument(
+            "--lines",
+            action="store_true",
+            help="Read each file line by line as `line` instead of reading the whole file as `text`."
+        )
+        file_stream_group.add_argument(
+            "--chunked",
+            type=byte_size,
+            metavar="SIZE",
+            help="Read each file in chunks of SIZE characters (bytes with -m rb) as `text`."
+        )
+        parser.add_argument(
+            "--pool",
+            choices=['thread', 'process'],
+            default='thread',
+            help="With -P N, read the files in N threads and run the code in the main process (thread), "
+                 "or run the code too in N worker processes (process)."
+        )
+        parser.set_defaults(handler=file_handler, command="file")
+
+    ## CUSTOM
+    def add_custom_options(parser):
+        parser.add_argument(
+            '-O', '--opt',
+            action="append",
+            dest="opts",
+            default=[],
+            type=key_value,
+        )
+        parser.add_argument(
+            "-N", "--name",
+            required=True,
+        )
+        parser.add_argument("codes", nargs='*')
+        parser.set_defaults(handler=custom_handler, command="custom")
+
+    ## BENCH
+    def add_bench_options(parser):
+        parser.add_argument(
+            "--records",
+            type=int,
+            default=100000,
+            help="Number of records of the generated data."
+        )
+        parser.add_argument(
+            "--repeat",
+            type=int,
+            default=3,
+            help="The best time of the repeated runs is reported."
+        )
+        parser.add_argument(
+            "--only",
+            metavar="REGEX",
+            help="Run only the cases whose name matches REGEX."
+        )
+        parser.add_argument(
+            "-o", "--output",
+            metavar="FILE",
+            help="Write the results to FILE instead of the standard output."
+        )
+        parser.add_argument(
+            "--baseline",
+            metavar="FILE",
+            help="Compare the results with a previous output and exit with an error on regressions."
+        )
+        parser.add_argument(
+            "--threshold",
+            type=float,
+            default=1.25,
+            help="A case is a regression when it is slower than the baseline by this ratio."
+        )
+        parser.set_defaults(handler=bench_handler, command="bench")
+
+    subcommands = [
+        ("line", ["l"], [add_common_options, add_loop_options, add_input_options, add_decompress_options,
+                         add_parallel_options, add_line_options]),
+        ("rec", ["r", "record"], [add_common_options, add_loop_options, add_input_options, add_decompress_options,
+                                  add_parallel_options, add_rec_csv_options, add_rec_options]),
+        ("csv", [], [add_common_options, add_loop_options, add_decompress_options, add_parallel_options,
+                     add_rec_csv_options, add_csv_options]),
+        ("text", ["t"], [add_common_options, add_loop_options, add_text_options]),
+        ("file", ["f"], [add_common_options, add_loop_options, add_input_options, add_decompress_options,
+                         add_parallel_options, add_file_options]),
+        ("custom", ["c"], [add_common_options, add_loop_options, add_custom_options]),
+        ("bench", [], [add_bench_options]),
+    ]
+    expected_1st_args = [
+        *(name for command, aliases, _ in subcommands for name in [command, *aliases]),
         "-h", "--help", "-V", "--version"
-    )
+    ]
     if len(argv) == 0 or argv[0] not in expected_1st_args:
         argv.insert(0, "line")
 
+    subparsers = parser.add_subparsers(
+        title="subcommands",
+        help="show subcommands help: %(prog)s subcommand -h"
+    )
+    for command, aliases, add_options in subcommands:
+        kwargs = {"help": "Run the benchmark suite and output the results as JSON."} if command == "bench" else {}
+        subparser = subparsers.add_parser(command, aliases=aliases, **kwargs)
+        # Only the options of the selected subcommand are added, since building
+        # all of them takes longer than running a cached code.
+        if argv[0] in (command, *aliases):
+            for add in add_options:
+                add(subparser)
+
     args = parser.parse_args(argv)
 
+    if args.command == "bench":
+        args.handler(args)
+        return
+
+    if args.view_table:
+        args.view = True
+
     if args.output_delimiter is None:
         if 'delimiter' in args and args.delimiter and len(args.delimiter) == 1:
             args.output_delimiter = args.delimiter
         else:
             args.output_delimiter = r'\t'
 
+    args.colored = is_colored(args)
+    args.cache_key = get_cache_key(args) if cache_enabled(args) else None
+    code = load_cached_code(args.cache_key) if args.cache_key else None
+    if code is not None:
+        if paging_enabled(args):
+            enable_pager(args)
+        exec_code(code, args)
+        return
+
+    if args.approx:
+        args.counter = True
+
+    if args.command == "file" and (args.lines or args.chunked) and args.parallel is not None:
+        parser.error("--lines and --chunked cannot be used with -P, --parallel")
+
+    if "decompress" in args and args.decompress and "reader" in args and args.reader == "mmap":
+        parser.error("--reader mmap cannot be used with -z, --decompress")
+
+    if args.stats_interval or args.stats_format:
+        args.stats = True
+
+    if args.stats and "reader" in args and args.reader == "mmap":
+        parser.error("--reader mmap cannot be used with --stats")
+
+    if args.command == "text":
+        if args.stream is not None:
+            args.json = True
+        elif args.loop_heads or args.filters:
+            parser.error("-e and -f can be used in text only with --stream")
+        elif args.head is not None or args.until:
+            parser.error("--head and --until can be used in text only with --stream")
+
+    if "head" in args and args.head is not None and args.head < 1:
+        parser.error("--head must be at least 1")
+
+    if ("parallel" in args and args.parallel is not None
+            and (args.head is not None or args.until)):
+        parser.error("--head and --until cannot be used with -P, --parallel")
+
+    if args.view_table and "parallel" in args and args.parallel is not None:
+        parser.error("--view-table cannot be used with -P, --parallel")
+
+    if "chunk_size" in args and args.chunk_size is None:
+        args.chunk_size = 1 if args.command == "file" else 10000
+
+    if is_batch(args):
+        if args.batch < 1:
+            parser.error("--batch must be at least 1")
+        for name, used in (("-c, --counter", args.counter), ("-g, --group-by", is_group_by(args)),
+                           ("-v, --view", args.view), ("-P, --parallel", args.parallel is not None),
+                           ("--head", args.head is not None), ("--until", bool(args.until))):
+            if used:
+                parser.error(f"--batch cannot be used with {name}")
+
+    if is_group_by(args):
+        if args.counter:
+            parser.error("--group-by cannot be used with -c, --counter")
+        try:
+            args.aggregations = parse_aggregations(args.agg)
+        except ValueError as e:
+            parser.error(str(e))
+
     args.all_code_trees = list(parse_all_codes(args))
-    if args.command in ("rec", "csv") and args.field_length is None:
-        if check_field_variables_in_code(args):
-            args.field_length = 0
+    if "field_type" in args and not args.header and any(isinstance(f, str) for f in args.field_type):
+        parser.error("--type with column names requires -H, --header")
+
+    if args.command in ("rec", "csv"):
+        args.field_numbers = get_field_numbers(args) if not args.field_length else []
+        args.header_keys = get_header_keys(args)
+        # Whether rec is needed is decided before dic["KEY"] becomes rec[_hN].
+        args.rec_is_needed = check_rec_is_needed(args)
+        if args.header_keys and not rewrite_header_keys(args):
+            args.header_keys = None
+            args.rec_is_needed = check_rec_is_needed(args)
 
     if not check_wrapping_is_need(args):
         args.no_wrapping = True
 
-    args.colored = is_colored(args)
     if paging_enabled(args):
         enable_pager(args)
 
@@ -1,17 +1,36 @@
+import bz2
+import gzip
+import importlib.util
 import io
+import itertools
+import json
+import os
+import signal
+import subprocess
 import sys
+import time
 from pathlib import Path
 
 import pytest
 
+import pypipe
 from pypipe import main
 
 TEST_DATA_DIR = Path(__file__).resolve().parent / 'data'
+IMPORT_TIME_BUDGET_US = 35_000
+STARTUP_BUDGET_MS = 35
+
+
+@pytest.fixture(autouse=True)
+def cache_dir(tmp_path, monkeypatch):
+    monkeypatch.setenv('PYPIPE_CACHE_DIR', str(tmp_path / 'cache'))
+    return tmp_path / 'cache'
 
 
 @pytest.mark.parametrize('input_text_file_name, expected_text_file_name, command', [
     ('staff.txt', 'ppp_line_1.txt', ['i, line.upper()', ]),
     ('staff.jsonlines.txt', 'ppp_line_2.txt', ['-j', 'dic["Name"]']),
+    ('staff.jsonlines.txt', 'ppp_line_2.txt', ['--json-backend', 'auto', '-j', 'dic["Name"]']),
     ('echo_line_1.txt', 'ppp_line_3.txt', ['line, math.sqrt(int(line))',]),
     ('echo_line_2.txt', 'ppp_line_4.txt', ['urllib.parse.urlparse(line)',]),
     ('staff.txt', 'ppp_rec_1.txt', ['rec', 'r[:3]']),
@@ -34,13 +53,53 @@ TEST_DATA_DIR = Path(__file__).resolve().parent / 'data'
     ('staff.txt', 'ppp_rec_17.txt', ['rec', 'f3,f2,f1']),
     ('echo_rec_4.txt', 'ppp_rec_18.txt', ['rec', '--view', '-t', '[(v, type(v)) for v in rec]']),
     ('staff.txt', 'ppp_rec_19.txt', ['rec', 'print(f1,f2,f3)']),
+    ('staff.txt', 'ppp_rec_24.txt', ['rec', '-d', r'\t+', 'f6, f1']),
+    ('staff.txt', 'ppp_rec_24.txt', ['rec', '-P2', '--chunk-size', '2', 'f6, f1']),
+    ('staff.txt', 'ppp_rec_25.txt', ['rec', '-H', 'f7, f1, len(rec)']),
+    ('staff.txt', 'ppp_rec_26.txt', ['rec', '-H', '--batch', '2', '--type', '2:i', 'f1, f2 * 1, sum(f2)']),
     ('staff.txt', 'ppp_rec_20.txt', ['rec', '-H', '-t', '-c', 'counter["TOTAL WEIGHT"] += f2']),
+    ('staff.txt', 'ppp_rec_21.txt', ['rec', '-H', '-g', 'f6', '--agg',
+                                     'count(), sum(f2), mean(int(f4)), max(f4), min(f3)']),
+    ('staff.txt', 'ppp_rec_21.txt', ['rec', '-H', '-P2', '--chunk-size', '2', '-g', 'f6', '--agg',
+                                     'count(), sum(f2), mean(int(f4)), max(f4), min(f3)']),
+    ('staff.txt', 'ppp_rec_21.txt', ['rec', '-H', '--type', 'Weight:i', '-g', 'd["Class"]', '--agg',
+                                     'count(), sum(dic["Weight"]), mean(int(f4)), max(dic["Age"]), min(f3)']),
+    ('staff.txt', 'ppp_rec_22.txt', ['rec', '-H', '-c', '--top', '1', 'f6']),
+    ('staff.txt', 'ppp_rec_22.txt', ['rec', '-H', '--approx', 'heavy', '--capacity', '2', '--top', '1', 'f6']),
+    ('staff.txt', 'ppp_rec_23.txt', ['rec', '-H', '--approx', 'distinct', 'f6']),
+    ('staff.txt', 'ppp_rec_23.txt', ['rec', '-H', '-P2', '--chunk-size', '2', '--approx', 'distinct', 'f6']),
     ('staff.csv', 'ppp_csv_1.txt', ['csv', '-O', 'quoting=csv.QUOTE_ALL']),
     ('staff.csv', 'ppp_csv_2.txt', ['csv', '-D', r'\t']),
     ('staff.csv', 'ppp_csv_3.txt', ['csv', '-H', '-f', 'int(f2) > 100']),
+    ('staff.csv', 'ppp_csv_3.txt', ['csv', '-H', '--type', 'Weight:i', '-f', 'dic["Weight"] > 100']),
     ('staff.csv', 'ppp_csv_4.txt', ['csv', '-t', '[type(v) for v in rec]']),
+    ('staff.csv', 'ppp_csv_5.txt', ['csv', '-H', '-g', 'f6, f5', '--agg', 'sum(f2)', '--top', '3']),
+    ('staff.csv', 'ppp_csv_6.txt', ['csv', '-H', '--batch', '3', '-t', '-f', '[w > 100 for w in f2]',
+                                    '-f', '[a < 50 for a in f4]']),
+    ('staff.csv', 'ppp_csv_6.txt', ['csv', '-H', '-t', '-f', 'f2 > 100', '-f', 'f4 < 50']),
+    ('staff.txt', 'ppp_line_1.txt', ['-P', '2', '--chunk-size', '2', 'i, line.upper()']),
+    ('staff.txt', 'ppp_rec_17.txt', ['rec', '-P2', '--chunk-size', '2', 'f3,f2,f1']),
+    ('staff.txt', 'ppp_rec_20.txt', ['rec', '-P2', '--chunk-size', '2', '-H', '-t', '-c',
+                                     'counter["TOTAL WEIGHT"] += f2']),
+    ('staff.csv', 'ppp_csv_3.txt', ['csv', '-P2', '--chunk-size', '1', '-H', '-f', 'int(f2) > 100']),
+    ('staff.txt', 'ppp_line_1.txt', ['--reader', 'block', '--block-size', '10', 'i, line.upper()']),
+    ('staff.txt', 'ppp_rec_3.txt', ['rec', '--reader', 'block', '--block-size', '16', '-H',
+                                    'rec[0], dic["Birth"]']),
+    ('staff.txt', 'ppp_line_1.txt', ['--reader', 'mmap', '-P2', '--block-size', '30', 'i, line.upper()']),
+    ('staff.txt', 'ppp_rec_3.txt', ['rec', '--reader', 'mmap', '--block-size', '16', '-H',
+                                    'rec[0], dic["Birth"]']),
+    ('staff.txt', 'ppp_rec_20.txt', ['rec', '--reader', 'mmap', '-P2', '--block-size', '40', '-H', '-t', '-c',
+                                     'counter["TOTAL WEIGHT"] += f2']),
+    ('staff.txt', 'ppp_rec_27.txt', ['rec', '-H', '--view-table', '-knever']),
+    ('staff.txt', 'ppp_rec_28.txt', ['rec', '-H', '-t', '-f', 'f2 > 10', '--head', '2', 'f1, f2']),
+    ('staff.txt', 'ppp_rec_29.txt', ['rec', '-H', '--until', 'dic["Name"] == "Pooh"', '-c', 'f6']),
+    ('staff.txt', 'ppp_rec_30.txt', ['rec', '-H', '-v', '-knever', '--head', '1']),
+    ('staff.txt', 'ppp_rec_10.txt', ['rec', '--output-buffer', '64', '-Fj']),
+    ('staff.txt', 'ppp_rec_16.txt', ['rec', '--output-buffer', '16', '-v', '-H', '-knever']),
+    ('staff.csv', 'ppp_csv_1.txt', ['csv', '--output-buffer', '1K', '-O', 'quoting=csv.QUOTE_ALL']),
     ('staff.txt', 'ppp_text_1.txt', ['text', "len(text)"]),
     ('staff.json', 'ppp_text_2.txt', ['text', '-j', 'dic["data"][0]']),
+    ('staff.json', 'ppp_text_2.txt', ['text', '--json-backend', 'auto', '-j', 'dic["data"][0]']),
     ('staff.json', 'ppp_text_3.txt', ['text', '-j', '-L', '-Fj', '*dic["data"]']),
     ('staff.json', 'ppp_text_4.txt', ['text', '-j', '-v', '-knever', 'dic']),
     ('staff.json', 'ppp_text_5.txt', ['text', '--convert', '-Fj', 'text["number_of_records"]']),
@@ -59,17 +118,533 @@ def test_ppp_common(input_text_file_name, expected_text_file_name, command, caps
         sys.stdin.close()
 
 
-def test_ppp_file(capsys):
+@pytest.mark.parametrize('options', [
+    [],
+    ['-P', '2'],
+    ['-P', '2', '--pool', 'process'],
+])
+def test_ppp_file(options, capsys):
     f = io.StringIO()
     f.write(str(TEST_DATA_DIR / 'input' / 'staff.json')+"\n")
     f.write(str(TEST_DATA_DIR / 'input' / 'staff.txt')+"\n")
     f.seek(0)
     sys.stdin = f
 
-    main(['file', 'path, len(text)'])
+    main(['file', *options, 'path, len(text)'])
     out, err = capsys.readouterr()
     expect = [
         str(TEST_DATA_DIR / 'input' / 'staff.json') + "\t" + "1046\n",
         str(TEST_DATA_DIR / 'input' / 'staff.txt') + "\t" + "231\n"
     ]
     assert out == ''.join(expect)
+
+
+@pytest.mark.parametrize('options, code, content, expect', [
+    (['--lines', '-f', 'i <= 2'], 'path.suffix, i, n, line', 'a\nb\nc\n',
+     ['.gz\t1\t1\ta', '.gz\t2\t2\tb', '.bz2\t1\t4\ta', '.bz2\t2\t5\tb']),
+    (['--lines', '-j'], 'dic["x"]', '{"x": 1}\n{"x": 2}\n', ['1', '2', '1', '2']),
+    (['--chunked', '4'], 'path.suffix, i, repr(text)', 'a\nb\nc\n',
+     [".gz\t1\t'a\\nb\\n'", ".gz\t2\t'c\\n'", ".bz2\t1\t'a\\nb\\n'", ".bz2\t2\t'c\\n'"]),
+])
+def test_ppp_file_stream(options, code, content, expect, tmp_path, capsys):
+    paths = [tmp_path / 'a.txt.gz', tmp_path / 'a.txt.bz2']
+    for path, module in zip(paths, (gzip, bz2)):
+        with module.open(path, 'wt') as f:
+            f.write(content)
+    sys.stdin = io.StringIO(''.join(f'{path}\n' for path in paths))
+    main(['file', *options, code])
+    out, err = capsys.readouterr()
+    assert out.splitlines() == expect
+
+
+@pytest.mark.parametrize('command', [
+    ['--errors', 'replace', 'i, line'],
+    ['--reader', 'block', '--block-size', '3', '--errors', 'replace', 'i, line'],
+])
+def test_ppp_decode_errors(command, capsys):
+    sys.stdin = io.TextIOWrapper(io.BytesIO(b'abc\r\nd\xffe\nf'), encoding='utf-8')
+    try:
+        main(command)
+        out, err = capsys.readouterr()
+        assert out == '1\tabc\n2\td\ufffde\n3\tf\n'
+    finally:
+        sys.stdin.close()
+
+
+def test_ppp_infer_types(capsys):
+    rows = [",".join([str(i * j) for j in range(10)] + [f"{i / 7:.3f}", "abc", "true"]) for i in range(500)]
+    # Records that the inferred converters cannot convert fall back to _convert.
+    rows[300] = "1.5,x,null,[1],4,5,6,7,8,9,0.1,abc,false"
+    rows[400] = "1,2,3"
+    # The inferred converters give the same values as _convert: an int in
+    # a float column stays an int, and a str column still converts null.
+    rows[450] = "1,2,3,4,5,6,7,8,9,10,3,null,None"
+    rows[460] = "1,2,3,4,5,6,7,8,9,10,-2.5,123,true"
+    text = "\n".join(rows) + "\n"
+
+    def run(infer_types):
+        sys.stdin = io.StringIO(text)
+        main(['rec', '-d', ',', '-t', '--infer-types', infer_types, 'repr(rec)'])
+        out, err = capsys.readouterr()
+        return out
+
+    generic = run('0')
+    assert run('100') == generic
+    assert "[1.5, 'x', None, [1], 4" in generic
+    assert "10, 3, None, None]" in generic
+    assert "10, -2.5, 123, True]" in generic
+
+
+@pytest.mark.parametrize('options', [
+    [],
+    ['--reader', 'block', '--block-size', '5'],
+    ['--reader', 'mmap', '--block-size', '5'],
+    ['--reader', 'mmap', '-P2', '--chunk-size', '1'],
+])
+def test_ppp_reader_utf16(options, tmp_path, capsys):
+    # U+0A00 contains the byte of '\n' in UTF-16.
+    path = tmp_path / 'utf16.tsv'
+    path.write_bytes('h\tx\n\u0a00\t1\nb\t2\r\n'.encode('utf-16'))
+    sys.stdin = open(path)
+    try:
+        main(['rec', '-H', '--encoding', 'utf-16', *options, 'f1, f2'])
+        out, err = capsys.readouterr()
+        assert out == '\u0a00\t1\nb\t2\n'
+    finally:
+        sys.stdin.close()
+
+
+@pytest.mark.parametrize('codes, loads', [
+    (['dic["Name"], d["Age"]'], "dic = _json_project(line, ('Age', 'Name'))"),
+    (['-f', 'dic["Age"] > 20', 'dic["Name"]'], "dic = _json_project(line, ('Age', 'Name'))"),
+    (['dic'], "dic = _json_loads(line)"),
+    (['dic.get("Name")'], "dic = _json_loads(line)"),
+    (['dic[key]'], "dic = _json_loads(line)"),
+    (['*dic["Name"]'], "dic = _json_project(line, ('Name',))"),
+])
+def test_ppp_json_projection(codes, loads, capsys):
+    main(['line', '-p', '-j', '--json-backend', 'simdjson', *codes])
+    out, err = capsys.readouterr()
+    assert f"    {loads}\n" in out
+
+
+@pytest.mark.parametrize('compress, command', [
+    (lambda b: gzip.compress(b[:4]) + gzip.compress(b[4:]), ['rec', '-z', 'f2, f1']),
+    (bz2.compress, ['rec', '-z', '--reader', 'block', 'f2, f1']),
+    (gzip.compress, ['csv', '--decompress', 'gzip', '-d', r'\t', 'f2, f1']),
+    (lambda b: b, ['rec', '-z', 'f2, f1']),
+])
+def test_ppp_decompress(compress, command, capsys):
+    sys.stdin = io.TextIOWrapper(io.BytesIO(compress(b'a\tb\nc\td\n')), encoding='utf-8')
+    try:
+        main(command)
+        out, err = capsys.readouterr()
+        assert out.splitlines() == ['b\ta', 'd\tc']
+    finally:
+        sys.stdin.close()
+
+
+class _Trickle(io.RawIOBase):
+    # Returns one byte per read, like a pipe whose writer writes byte by byte.
+
+    def __init__(self, data):
+        self.data = data
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        n = min(len(b), len(self.data), 1)
+        b[:n], self.data = self.data[:n], self.data[n:]
+        return n
+
+
+@pytest.mark.parametrize('compress', [gzip.compress, bz2.compress, lambda b: b])
+def test_ppp_decompress_short_reads(compress, capsys):
+    sys.stdin = io.TextIOWrapper(io.BufferedReader(_Trickle(compress(b'a\tb\nc\td\n')), 1), encoding='utf-8')
+    try:
+        main(['rec', '-z', 'f2, f1'])
+        out, err = capsys.readouterr()
+        assert out.splitlines() == ['b\ta', 'd\tc']
+    finally:
+        sys.stdin.close()
+
+
+def test_ppp_file_decompress(tmp_path, capsys):
+    path = tmp_path / 'data'
+    path.write_bytes(gzip.compress(b'abc'))
+    sys.stdin = io.StringIO(f'{path}\n')
+    main(['file', '-z', 'text'])
+    out, err = capsys.readouterr()
+    assert out == 'abc\n'
+
+
+@pytest.mark.parametrize('text, command, expect', [
+    ('[1, 2.5, {"a": [1, 2]}, "x", null]', ['*', 'i, dic'],
+     ['1\t1', '2\t2.5', "3\t{'a': [1, 2]}", '4\tx', '5\tNone']),
+    ('{"meta": {"n": [1]}, "items": [{"id": 1}, {"id": 22}], "z": 0}', ['items.*', '-f', 'dic["id"] > 1', 'dic["id"]'],
+     ['22']),
+    ('{"a": 1, "b": 2}', ['*', 'key, dic'], ['a\t1', 'b\t2']),
+    ('[]', ['*'], []),
+    # The numbers and strings cross the boundaries of the 1 MiB read buffer.
+    (json.dumps([12345678, "x" * 3000] * 400), ['*', '-c', 'type(dic).__name__'], ['int\t400', 'str\t400']),
+])
+def test_ppp_text_stream(text, command, expect, capsys):
+    sys.stdin = io.StringIO(text)
+    main(['text', '--stream', *command])
+    out, err = capsys.readouterr()
+    assert out.splitlines() == expect
+
+
+def test_ppp_bench(tmp_path, capsys):
+    output = tmp_path / 'bench.json'
+    main(['bench', '--records', '200', '--repeat', '1', '--only', '^(rec|csv_header|file_gzip)$', '-o', str(output)])
+    report = json.loads(output.read_text())
+    assert list(report['results']) == ['rec', 'csv_header', 'file_gzip']
+
+    baseline = tmp_path / 'baseline.json'
+    baseline.write_text(json.dumps({'results': {name: 60.0 for name in report['results']}}))
+    main(['bench', '--records', '200', '--repeat', '1', '--only', '^rec$', '--baseline', str(baseline)])
+    out, err = capsys.readouterr()
+    assert json.loads(out)['results'].keys() == {'rec'}
+
+    baseline.write_text(json.dumps({'results': {'rec': 0.0001}}))
+    with pytest.raises(SystemExit, match='regressions'):
+        main(['bench', '--records', '200', '--repeat', '1', '--only', '^rec$', '--baseline', str(baseline)])
+
+
+def test_ppp_bench_speedups(monkeypatch, capsys):
+    # The inferred conversions of -t must stay faster than the generic converter.
+    main(['bench', '--records', '30000', '--repeat', '2', '--only', '^rec_convert'])
+    out, err = capsys.readouterr()
+    assert json.loads(out)['results'].keys() == {'rec_convert', 'rec_convert_generic'}
+    assert 'rec_convert / rec_convert_generic' in err
+
+    monkeypatch.setattr(pypipe, 'BENCH_SPEEDUPS', [('rec_convert', 'rec_convert_generic', 0.0)])
+    with pytest.raises(SystemExit, match='not faster than the reference cases: rec_convert'):
+        main(['bench', '--records', '200', '--repeat', '1', '--only', '^rec_convert'])
+
+
+CSV_TRICKY = 'a,b,c\n"x,1",y,"say ""hi"""\n\nq\n"multi\nline",z,\na"b,"c\nd",e\n1,2,3'
+
+
+@pytest.mark.parametrize('options', [
+    ['i, rec'],
+    ['-H', 'dic'],
+    ['[None, 1.5, True, "p,q", 3, "", f1]'],
+    ['""'],
+    ['[]'],
+    ['-P', '2', '--chunk-size', '2', 'rec'],
+])
+def test_ppp_csv_engine(options, capsys):
+    outputs = []
+    for engine in ('auto', 'csv'):
+        sys.stdin = io.StringIO(CSV_TRICKY)
+        main(['csv', '--csv-engine', engine, *options])
+        out, err = capsys.readouterr()
+        outputs.append(out)
+    assert outputs[0] == outputs[1]
+
+
+@pytest.mark.parametrize('options, expected', [
+    # Compiled to rec[INDEX]. A duplicated name refers to the last column,
+    # and a missing one raises KeyError only when it is read.
+    (['dic["b"], d["a"]'], 'y\t1\nw\t3\n'),
+    (['dic["a"] if i < 9 else dic["nope"]'], '1\n3\n'),
+    (['dic["a"] if i > 1 else dic["nope"]'], None),
+    # dic escapes or rec is modified: a dict is built per record.
+    (['dic.get("nope", dic["a"])'], '1\n3\n'),
+    (['sorted(dic)'], 'a\tb\na\tb\n'),
+    (['-e', 'rec[0] = "z"', 'dic["a"], rec[0]'], '1\tz\n3\tz\n'),
+    # A parameter named d, dic or rec hides the one of the record.
+    (['sorted([{"x": 2}, {"x": 1}], key=lambda d: d["x"])'], "{'x': 1}\t{'x': 2}\n" * 2),
+    (['-b', 'def g(d): return d["k"] * 2', 'g({"k": 1}), dic["a"]'], '2\t1\n2\t3\n'),
+    (['(lambda rec: dic["a"])(None)'], '1\n3\n'),
+])
+def test_ppp_header_keys(options, expected, capsys):
+    sys.stdin = io.StringIO('a\tb\tb\n1\tx\ty\n3\tv\tw\n')
+    if expected is None:
+        with pytest.raises(KeyError, match='nope'):
+            main(['rec', '-H', *options])
+        return
+    main(['rec', '-H', *options])
+    out, err = capsys.readouterr()
+    assert out == expected
+
+
+@pytest.mark.parametrize('options, expected', [
+    (['f1 + f2'], '3\n7\n'),
+    (['-f', 'f1 > 1', 'f1, f2'], '3\t4\n'),
+    (['-f', 'f1 > 0', '-f', 'f2 < 4', 'f2 * 2, -f1, 10 - f1'], '4\t-1\t9\n'),
+    (['-t', 'f1 / 2, f1 == 3'], '0.5\tFalse\n1.5\tTrue\n'),
+])
+def test_ppp_batch_elementwise(options, expected, capsys):
+    # The operators are applied elementwise with or without NumPy.
+    sys.stdin = io.StringIO('1\t2\n3\t4\n')
+    main(['rec', '--batch', '10', '--type', '1:i,2:i', *options])
+    out, err = capsys.readouterr()
+    assert out == expected
+
+
+@pytest.mark.parametrize('options', [
+    ['--type', '2:i'],
+    ['-t'],
+    [],
+])
+def test_ppp_batch_ragged(options, capsys):
+    # Empty cells and missing fields are kept as in the row mode.
+    for batch in ([], ['--batch', '10']):
+        sys.stdin = io.StringIO('a\t1\nb\t\nc\n')
+        main(['rec', *batch, *options, 'f1, f2'])
+        out, err = capsys.readouterr()
+        assert out == 'a\t1\nb\t\nc\tNone\n'
+
+
+@pytest.mark.parametrize('parallel', [[], ['-P2', '--chunk-size', '1']])
+@pytest.mark.parametrize('last', ['c\n', 'c\t\n', 'c\t\na\t\n'])
+def test_ppp_group_by_ragged(parallel, last, capsys):
+    # Missing fields and empty cells are skipped by the aggregations.
+    sys.stdin = io.StringIO('a\t1\nb\t2\na\t3\n' + last)
+    main(['rec', *parallel, '-g', 'f1', '--agg', 'max(f2), min(f2), sum(f2), mean(f2)'])
+    out, err = capsys.readouterr()
+    assert out == 'a\t3\t1\t4\t2.0\nb\t2\t2\t2\t2.0\nc\tNone\tNone\t0\tNone\n'
+
+
+def test_ppp_profile(tmp_path, monkeypatch, capsys):
+    sys.stdin = io.StringIO(''.join(f'{i}\t{i * 2}\n' for i in range(20000)))
+    main(['rec', '-t', '--profile', 'sample', '-f', 'f2 > 10', 'f1 + f2'])
+    out, err = capsys.readouterr()
+    assert out.splitlines()[0] == '18'
+    assert err.startswith('# PROFILE (sample')
+    assert 'SECTION' in err
+
+    # The sampler does not run along with cProfile.
+    timers = []
+    if hasattr(signal, 'setitimer'):
+        monkeypatch.setattr(signal, 'setitimer', lambda *args: timers.append(args))
+    output = tmp_path / 'ppp.prof'
+    sys.stdin = io.StringIO('1\n2\n')
+    main(['line', '--profile', 'cprofile', '--profile-output', str(output), 'int(line) * 2'])
+    out, err = capsys.readouterr()
+    assert out == '2\n4\n'
+    assert 'tottime' in err
+    assert 'SECTION' not in err
+    assert output.exists()
+    assert timers == []
+
+
+def test_ppp_profile_helper_labels():
+    source = '# PRE\nx = 1\n\ndef _print(*args):\n    print(*args)\n\nclass _C:\n    pass\n' \
+             'y = 2\nfor line in sys.stdin:\n    # MAIN\n    _print(line)\n'
+    labels = pypipe.get_helper_labels(source, pypipe.get_code_sections(source))
+    assert [labels[n] for n in range(1, 13)] == [
+        'PRE', 'PRE', 'PRE', '_print', '_print', '_print', '_C', '_C', 'PRE', 'LOOP', 'MAIN', 'MAIN']
+
+
+def test_ppp_stats(capsys):
+    sys.stdin = io.TextIOWrapper(io.BytesIO(b'1\n2\n3\n4\n5'))
+    main(['line', '--stats', '-f', 'int(line) % 2', 'line'])
+    out, err = capsys.readouterr()
+    assert out == '1\n3\n5\n'
+    assert err.startswith('# STATS records_in=5 filtered=2 records_out=3 bytes_in=9 bytes_out=6 ')
+
+    sys.stdin = io.TextIOWrapper(io.BytesIO(gzip.compress(b'a,b\nc,d\n')))
+    main(['csv', '-z', '--stats-format', 'json', 'rec[::-1]'])
+    out, err = capsys.readouterr()
+    assert out.splitlines() == ['b,a', 'd,c']
+    stats = json.loads(err)
+    assert stats['type'] == 'stats'
+    assert (stats['records_in'], stats['filtered'], stats['records_out'], stats['bytes_in']) == (2, None, 2, 8)
+
+    # The header is not a record, and a lone \r does not end a line as in sys.stdin.
+    sys.stdin = io.TextIOWrapper(io.BytesIO(b'h1\th2\na\rb\t1\nc\t2\n'))
+    main(['rec', '-H', '--stats', 'repr(f1)'])
+    out, err = capsys.readouterr()
+    assert out == "'a\\rb'\n'c'\n"
+    assert err.startswith('# STATS records_in=2 records_out=2 ')
+
+
+def test_ppp_view_table(capsys):
+    sys.stdin = io.StringIO('a\t1\nbbbbbb\t22\nc\t{"k": 1}\n')
+    main(['rec', '--view-table', '--view-sample', '1', '-knever', 'f1, f2 if i < 3 else {"x": "1\\n2"}'])
+    out, err = capsys.readouterr()
+    assert out.splitlines() == [
+        '1 | a | 1',
+        '2 | bbbbbb | 22',
+        "3 | c | {'x': '1\\n2'}",
+    ]
+
+    # The table is output before the post codes.
+    sys.stdin = io.StringIO('a\tb\n1\t2\n')
+    main(['rec', '-H', '--view-table', '-a', 'print("POST")'])
+    out, err = capsys.readouterr()
+    assert out.splitlines()[-1] == 'POST'
+    assert len(out.splitlines()) > 1
+
+
+def test_ppp_head(capsys):
+    # The loop stops without reading the rest of an endless input.
+    sys.stdin = itertools.repeat('y\n')
+    main(['line', '--head', '3', '-a', 'print("end")', 'i, line'])
+    out, err = capsys.readouterr()
+    assert out == '1\ty\n2\ty\n3\ty\nend\n'
+
+    sys.stdin = io.StringIO(''.join(f'{TEST_DATA_DIR / "input" / name}\n' for name in ('echo_line_1.txt', 'staff.txt')))
+    main(['file', '--lines', '--until', 'path.name == "staff.txt"', 'path.name'])
+    out, err = capsys.readouterr()
+    with open(TEST_DATA_DIR / 'input' / 'echo_line_1.txt') as f:
+        assert out == 'echo_line_1.txt\n' * len(f.readlines())
+
+
+def test_ppp_cache(cache_dir, monkeypatch, capsys):
+    for _ in range(2):
+        sys.stdin = io.StringIO('4\n9\n')
+        main(['line', 'math.sqrt(int(line))'])
+        out, err = capsys.readouterr()
+        assert out == '2.0\n3.0\n'
+        # The second run must not generate the code again.
+        monkeypatch.setattr(pypipe, 'parse_all_codes', None)
+    assert len(list(cache_dir.glob('*.bin'))) == 1
+
+
+def test_ppp_cache_auto_import(cache_dir, tmp_path, monkeypatch, capsys):
+    # A module added to sys.path after a run is imported by the next run.
+    monkeypatch.syspath_prepend(str(tmp_path))
+    sys.stdin = io.StringIO('x\n')
+    with pytest.raises(NameError):
+        main(['line', 'zzmod.f(line)'])
+    (tmp_path / 'zzmod.py').write_text('def f(s):\n    return s * 2\n')
+    importlib.invalidate_caches()
+    monkeypatch.delitem(sys.modules, 'zzmod', raising=False)
+    monkeypatch.setattr(pypipe, '_found_modules', {})
+    sys.stdin = io.StringIO('x\n')
+    main(['line', 'zzmod.f(line)'])
+    out, err = capsys.readouterr()
+    assert out == 'xx\n'
+
+
+def test_ppp_cache_eviction(cache_dir, monkeypatch, capsys):
+    monkeypatch.setenv('PYPIPE_CACHE_SIZE', '1')
+    for code in ('line', 'line.upper()', 'line.lower()'):
+        sys.stdin = io.StringIO('a\n')
+        main(['line', code])
+    assert len(list(cache_dir.glob('*.bin'))) == 1
+    sys.stdin = io.StringIO('a\n')
+    main(['line', '--no-cache', 'line * 2'])
+    assert len(list(cache_dir.glob('*.bin'))) == 1
+
+
+@pytest.mark.skipif(sys.version_info < (3, 7), reason='-X importtime is available from Python 3.7')
+def test_ppp_import_time():
+    proc = subprocess.run(
+        [sys.executable, '-X', 'importtime', pypipe.__file__, 'line'],
+        input='x\n', stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True, check=True,
+        env={'PYPIPE_CACHE': 'false'},
+    )
+    assert proc.stdout == 'x\n'
+    imported = {}
+    for line in proc.stderr.splitlines():
+        if line.startswith('import time:') and not line.endswith('imported package'):
+            _, cumulative, name = line.split('|')
+            imported[name.strip()] = (int(cumulative), not name.startswith('  '))
+    for name in ('ast', 'importlib.util', 'subprocess', 'signal', 'hashlib'):
+        assert name not in imported
+    total = sum(us for us, top_level in imported.values() if top_level)
+    assert total < IMPORT_TIME_BUDGET_US
+
+
+@pytest.mark.skipif(sys.version_info < (3, 8), reason='PYTHONPYCACHEPREFIX requires Python 3.8')
+def test_ppp_startup_time(tmp_path):
+    # A full run of ppp, on top of the start-up of the interpreter, with the
+    # bytecode of pypipe and the generated code cached as for an installed ppp.
+    env = {**os.environ, 'PYPIPE_CACHE_DIR': str(tmp_path / 'cache'), 'PYTHONPYCACHEPREFIX': str(tmp_path / 'pyc')}
+    env.pop('PYTHONDONTWRITEBYTECODE', None)
+
+    def median_ms(*args):
+        times = []
+        for _ in range(11):
+            start = time.perf_counter()
+            proc = subprocess.run(
+                [sys.executable, *args], input='4\n', stdout=subprocess.PIPE, universal_newlines=True,
+                env=env, cwd=str(Path(pypipe.__file__).parent), check=True,
+            )
+            times.append(time.perf_counter() - start)
+        return sorted(times)[len(times) // 2] * 1000, proc.stdout
+
+    interpreter, _ = median_ms('-c', 'pass')
+    script = 'import sys, pypipe; pypipe.main(sys.argv[1:])'
+    # The first run fills the caches, and the others hit them.
+    for codes, expected in (([], '4\n'), (['math.sqrt(int(line)), os.sep'], f'2.0\t{os.sep}\n')):
+        elapsed, out = median_ms('-c', script, 'line', *codes)
+        assert out == expected
+        assert elapsed - interpreter < STARTUP_BUDGET_MS
+
+
+def test_ppp_negative_imports_eviction(cache_dir, monkeypatch, capsys):
+    # The least recently missed names are dropped first, whatever their names.
+    monkeypatch.setattr(pypipe, 'NEGATIVE_IMPORTS_SIZE', 2)
+    for name in ('aanosuchmodule', 'zznosuchmodule', 'mmnosuchmodule'):
+        monkeypatch.setattr(pypipe, '_found_modules', {})
+        sys.stdin = io.StringIO('x\n')
+        main(['line', f'{name}.f if False else line'])
+    out, err = capsys.readouterr()
+    assert out == 'x\n' * 3
+    assert pypipe.load_negative_imports() == ['zznosuchmodule', 'mmnosuchmodule']
+
+
+def test_ppp_pager():
+    script = 'import sys, pypipe; pypipe.paging_enabled = lambda args: True; pypipe.main(sys.argv[1:])'
+    env = {**os.environ, 'PYPIPE_CACHE': 'false', 'PYTHONIOENCODING': 'utf-8',
+           'PYTHONPATH': str(Path(pypipe.__file__).parent)}
+    proc = subprocess.run([sys.executable, '-c', script, 'line', 'line.upper()'], input='é\nb\n'.encode(),
+                          stdout=subprocess.PIPE, stderr=subprocess.PIPE, timeout=30,
+                          env={**env, 'PYPIPE_PAGER': 'cat'})
+    assert (proc.returncode, proc.stdout, proc.stderr) == (0, 'É\nB\n'.encode(), b'')
+
+    # Quitting the pager stops reading an endless input.
+    endless = subprocess.Popen([sys.executable, '-c', 'import sys\nwhile True: sys.stdout.write("y\\n" * 1000)'],
+                               stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+    try:
+        proc = subprocess.run([sys.executable, '-c', script, 'line', '-f', 'False', 'line'], stdin=endless.stdout,
+                              stdout=subprocess.PIPE, stderr=subprocess.PIPE, timeout=30,
+                              env={**env, 'PYPIPE_PAGER': 'true'})
+    finally:
+        endless.kill()
+        endless.wait()
+        endless.stdout.close()
+    assert (proc.returncode, proc.stderr) == (0, b'')
+
+    # The pager shows the lines of a slow input before the input ends.
+    slow = subprocess.Popen([sys.executable, '-c', 'import time\nprint("a", flush=True)\ntime.sleep(60)'],
+                            stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+    try:
+        proc = subprocess.run([sys.executable, '-c', script, 'line', 'line.upper()'], stdin=slow.stdout,
+                              stdout=subprocess.PIPE, stderr=subprocess.PIPE, timeout=30,
+                              env={**env, 'PYPIPE_PAGER': 'head -n 1'})
+    finally:
+        slow.kill()
+        slow.wait()
+        slow.stdout.close()
+    assert (proc.returncode, proc.stdout, proc.stderr) == (0, b'A\n', b'')
+
+
+def test_ppp_auto_import_probes(cache_dir, monkeypatch, capsys):
+    probed = []
+    find_spec = importlib.util.find_spec
+
+    def _find_spec(name, *args):
+        probed.append(name)
+        return find_spec(name, *args)
+
+    monkeypatch.setattr(importlib.util, 'find_spec', _find_spec)
+    for loop_head in ('x = 1', 'x = 2'):
+        monkeypatch.setattr(pypipe, '_found_modules', {})
+        probed.clear()
+        sys.stdin = io.StringIO('a\tb\n')
+        main(['rec', '-b', 'foo = "x"', '-e', loop_head, '--no-wrapping',
+              'nosuchmodule.f if False else _print(foo.upper(), rec.count("a"), f1.strip(), str.upper(f2), math.pi)'])
+        out, err = capsys.readouterr()
+        assert out == 'X\t1\ta\tB\t3.141592653589793\n'
+        assert not {'foo', 'rec', 'f1', 'str'} & set(probed)
+    # The miss of the first run is persisted in the negative cache.
+    assert probed == ['math']